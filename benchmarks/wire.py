@@ -0,0 +1,78 @@
+# This file is part of DTE-ERAU. Copyright 2023 Embry-Riddle Aeronautical University
+#
+# DTE-ERAU is free software: you can redistribute it and/or modify it under the terms of the GNU 
+# General Public License as published by the Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# DTE-ERAU is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. 
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with DTE-ERAU. If not, see 
+# <https://www.gnu.org/licenses/>. 
+
+# Compares JSON and MessagePack for a TScP push of the given size: encoding, decoding, size on the wire and,
+# when given the URL of a running DTE, the time for it to take the push.
+#
+#   python benchmarks/wire.py --users 100000 --keys 8 [--url http://localhost:9991]
+
+import argparse
+import os
+import random
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dte'))
+from wire import JSON, MSGPACK, dumps, loads
+
+
+def push(users: int, keys: int) -> dict:
+    names = [f'network:physical_network:score_{k}' for k in range(keys)]
+    return {
+        'name': 'bench',
+        'version': 1,
+        'scores': {f'user-{u}': {k: random.random() for k in names} for u in range(users)},
+    }
+
+
+def best(f, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def post(url: str, body: bytes, content_type: str) -> float:
+    request = urllib.request.Request(f'{url}/update', data=body, method='POST',
+                                     headers={'Content-Type': content_type, 'Accept': content_type})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--keys', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--url', help='A running DTE to send the push to')
+    args = parser.parse_args()
+
+    data = push(args.users, args.keys)
+    print(f'{args.users} users x {args.keys} keys')
+    print(f'{"format":<12}{"size":>12}{"encode":>12}{"decode":>12}{"DTE":>12}')
+    for content_type in (JSON, MSGPACK):
+        body = dumps(data, content_type)
+        encode = best(lambda: dumps(data, content_type), args.repeat)
+        decode = best(lambda: loads(body, content_type), args.repeat)
+        remote = f'{post(args.url, body, content_type) * 1000:.1f}ms' if args.url else '-'
+        print(f'{content_type.split("/")[1]:<12}{len(body) / 1e6:>10.1f}MB{encode * 1000:>10.1f}ms'
+              f'{decode * 1000:>10.1f}ms{remote:>12}')
+
+
+if __name__ == '__main__':
+    main()
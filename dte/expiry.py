@@ -0,0 +1,121 @@
+# This file is part of DTE-ERAU. Copyright 2023 Embry-Riddle Aeronautical University
+#
+# DTE-ERAU is free software: you can redistribute it and/or modify it under the terms of the GNU 
+# General Public License as published by the Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# DTE-ERAU is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. 
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with DTE-ERAU. If not, see 
+# <https://www.gnu.org/licenses/>. 
+
+import heapq
+import numpy as np
+from datetime import timedelta
+from store import ScoreTable
+from typing import Callable, Optional
+
+LIVE = 'live'
+OLD = 'old'
+STALE = 'stale'
+
+
+class ExpiryIndex:
+    """
+    Moves the scores of a table from live to old to evicted using a heap of deadlines, one per user row.
+
+    Refreshing a score does not touch the heap. Instead a row is rescheduled when it comes due and turns out to have
+    been updated since, so a refresh is O(1) and expiring is O(rows that came due).
+    """
+    def __init__(self, table: ScoreTable, old: timedelta, stale: timedelta):
+        self.table = table
+        self.old = old.total_seconds()
+        self.stale = stale.total_seconds()
+        self._heap = []  # type: list[tuple[float, int]]
+        self._scheduled = np.zeros(1024, dtype=bool)  # Rows with an item in the heap
+        self.evicted = 0
+
+    def touch(self, rows: np.ndarray, ts: float) -> None:
+        if len(rows) == 0:
+            return
+        if rows.max() >= len(self._scheduled):
+            scheduled = np.zeros(max(len(self._scheduled) * 2, rows.max() + 1), dtype=bool)
+            scheduled[:len(self._scheduled)] = self._scheduled
+            self._scheduled = scheduled
+        new = np.unique(rows[~self._scheduled[rows]])
+        self._schedule([(ts + self.old, row) for row in new.tolist()])
+        self._scheduled[new] = True
+
+    def _schedule(self, items: list[tuple[float, int]]) -> None:
+        heap = self._heap
+        if len(items) > len(heap):
+            heap.extend(items)
+            heapq.heapify(heap)
+        else:
+            for item in items:
+                heapq.heappush(heap, item)
+
+    def state(self, ts: Optional[float], now: float) -> Optional[str]:
+        if ts is None:
+            return None
+        age = now - ts
+        if age < self.old:
+            return LIVE
+        if age < self.stale:
+            return OLD
+        return STALE
+
+    def next_deadline(self) -> Optional[float]:
+        return self._heap[0][0] if self._heap else None
+
+    def expire(self, now: float, refreshed: Callable[[np.ndarray], np.ndarray]) -> list[tuple[int, np.ndarray]]:
+        """
+        Process every row that came due, returns the (row, columns) that went stale.
+        `refreshed` gives for every score of the rows (rows x columns) the latest time it was known to be fresh besides
+        its own update (-inf for none).
+        """
+        heap = self._heap
+        due = []
+        while heap and heap[0][0] <= now:
+            due.append(heapq.heappop(heap)[1])
+        if not due:
+            return []
+
+        # All of the rows that came due are handled at once, which matters after a restart when everything is due
+        rows = np.array(due, dtype=np.intp)
+        updated = self.table.updated
+        rows = rows[rows < updated.shape[0]]
+        ts = updated[rows]
+        present = ts != 0
+        effective = np.maximum(ts / 1000, refreshed(rows))
+        dead = present & (effective + self.stale <= now)
+        evicted = [(int(rows[i]), np.flatnonzero(dead[i])) for i in np.flatnonzero(dead.any(axis=1)).tolist()]
+        self.evicted += int(np.count_nonzero(dead))
+
+        # Wake up again when the next score in the row turns old, or the next old one goes stale
+        turns_old = effective + self.old
+        deadlines = np.where(turns_old > now, turns_old, effective + self.stale)
+        deadlines[~present | dead] = np.inf
+        deadlines = deadlines.min(axis=1, initial=np.inf)
+        alive = np.isfinite(deadlines)
+        self._scheduled[due] = False
+        self._scheduled[rows[alive]] = True
+        self._schedule(list(zip(deadlines[alive].tolist(), rows[alive].tolist())))
+        return evicted
+
+    def counts(self, now: float, refreshed: Callable[[np.ndarray], np.ndarray]) -> dict[str, int]:
+        """
+        How many scores are live and old right now
+        """
+        rows = np.arange(self.table.rows)
+        ts = self.table.updated[rows]
+        present = ts != 0
+        effective = np.maximum(ts / 1000, refreshed(rows))
+        old = present & (effective + self.old <= now)
+        return {
+            LIVE: int(np.count_nonzero(present & ~old)),
+            OLD: int(np.count_nonzero(old)),
+            'evicted': self.evicted,
+        }
@@ -0,0 +1,113 @@
+# This file is part of DTE-ERAU. Copyright 2023 Embry-Riddle Aeronautical University
+#
+# DTE-ERAU is free software: you can redistribute it and/or modify it under the terms of the GNU 
+# General Public License as published by the Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# DTE-ERAU is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. 
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with DTE-ERAU. If not, see 
+# <https://www.gnu.org/licenses/>. 
+
+import asyncio
+import fnmatch
+import logging
+import re
+import time
+from typing import Callable, Iterable, Optional
+
+
+class Subscription:
+    """
+    Interest in a set of users and/or `tscp:key` patterns (fnmatch style, e.g. `near:network:*`).
+    Leaving either of them empty matches everything.
+    """
+    def __init__(self, users: Iterable[str] = (), keys: Iterable[str] = (), size: int = 1024):
+        self.queue = asyncio.Queue(maxsize=size)  # type: asyncio.Queue[list[dict]]
+        self.lost = False  # Events were dropped because the subscriber is not keeping up
+        self.set_interest(users, keys)
+
+    def set_interest(self, users: Iterable[str] = (), keys: Iterable[str] = ()) -> None:
+        self.users = set(users) or None
+        keys = list(keys)
+        self._keys = re.compile('|'.join(fnmatch.translate(k) for k in keys)) if keys else None
+
+    def matches(self, user: str, key: str) -> bool:
+        if self.users is not None and user not in self.users:
+            return False
+        return self._keys is None or self._keys.match(key) is not None
+
+    def offer(self, events: list[dict]) -> None:
+        try:
+            self.queue.put_nowait(events)
+        except asyncio.QueueFull:
+            self.lost = True
+
+    async def next(self) -> tuple[list[dict], bool]:
+        """
+        The next batch of events, and whether anything was dropped before it
+        """
+        events = await self.queue.get()
+        lost, self.lost = self.lost, False
+        return events, lost
+
+
+class ChangeFeed:
+    """
+    Collects score changes and hands them to the subscribers in batches. Changes to the same score within one
+    batch are merged into a single event, and dropped if the value ended up where it started.
+    """
+    def __init__(self, delay: float = 0.01):
+        self.log = logging.getLogger('ChangeFeed')
+        self.delay = delay
+        self.subscribers = set()  # type: set[Subscription]
+        self._pending = {}  # type: dict[tuple[str, str], list[Optional[float]]]
+        self._flush_handle = None  # type: Optional[asyncio.TimerHandle]
+        self.on_active = None  # type: Optional[Callable[[bool], None]]  # Called when the first one subscribes or the last one leaves
+
+    @property
+    def active(self) -> bool:
+        return bool(self.subscribers)
+
+    def subscribe(self, users: Iterable[str] = (), keys: Iterable[str] = ()) -> Subscription:
+        sub = Subscription(users, keys)
+        self.subscribers.add(sub)
+        self.log.info(f'New subscriber ({len(self.subscribers)} total)')
+        if len(self.subscribers) == 1 and self.on_active is not None:
+            self.on_active(True)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        if sub in self.subscribers:
+            self.subscribers.discard(sub)
+            if not self.subscribers and self.on_active is not None:
+                self.on_active(False)
+
+    def publish(self, user: str, key: str, old: Optional[float], new: Optional[float]) -> None:
+        if not self.subscribers:
+            return
+        pending = self._pending.get((user, key))
+        if pending is None:
+            self._pending[(user, key)] = [old, new]
+        else:
+            pending[1] = new
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.delay, self._flush)
+
+    def _flush(self) -> None:
+        self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        now = time.time()
+        events = [
+            (user, key, {'user': user, 'key': key, 'old': old, 'new': new, 'time': now})
+            for (user, key), (old, new) in pending.items()
+            if old != new
+        ]
+        if not events:
+            return
+        for sub in self.subscribers:
+            matched = [event for user, key, event in events if sub.matches(user, key)]
+            if matched:
+                sub.offer(matched)
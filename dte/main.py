@@ -11,33 +11,46 @@
 # You should have received a copy of the GNU General Public License along with DTE-ERAU. If not, see 
 # <https://www.gnu.org/licenses/>. 
 
+import aiohttp
 import asyncio
-import base64
+import json
 import logging
-import re
+import numpy as np
+import os
 import time
 import yaml
 from aiohttp import web
-from datetime import datetime, timedelta
-from lupa import LuaRuntime
-from typing import Iterable
-from watchdog.events import FileSystemEventHandler
+from datetime import timedelta
+from expiry import ExpiryIndex, LIVE, STALE
+from feed import ChangeFeed
+from mapping import MappingRegistry, VARIABLE
+from persist import EVICT, ONRAMP, SET, Persistence
+from reload import Reloader
+from sandbox import Sandbox
+from store import Interner, RowView, ScoreTable, to_ms
+from typing import Iterable, Sequence
+from wire import read, read_response, request_args, respond
 
 logging.basicConfig(level=logging.INFO)
 root = logging.getLogger()
 logging.getLogger('aiohttp.access').setLevel(logging.ERROR)
 root.debug("Starting...")
 
-routes = web.RouteTableDef()
+# Pulling scores from TScPs on a miss
+PULL_TIMEOUT = aiohttp.ClientTimeout(total=1)
+PULL_BACKOFF = 5  # Seconds before the same user is pulled from a TScP again
+PULL_CONCURRENCY = 16  # Concurrent pulls per TScP
+
+SCORE_BATCH = 1024  # Users scored before other requests get a turn
 
+# Full pushes of large TScPs are well past the default limit of 1MB
+MAX_BODY = 1024 ** 3
+
+# float32 halves the memory of the scores, at the cost of precision
+SCORE_DTYPE = np.dtype(os.environ.get('DTE_SCORE_DTYPE', 'float64'))
+
+routes = web.RouteTableDef()
 
-class WatchdogHandler(FileSystemEventHandler):
-    def __init__(self, callback):
-        self.callback = callback
-      
-    def on_modified(self, event):
-        time.sleep(0.1)
-        self.callback(event.src_path)
 
 """
 A TScP for local testing
@@ -48,167 +61,652 @@ class FileTScP:
         self.log.info(f'Starting TScP ({location})')
         self.name = name
         self.location = location
-        self.reload()
+        self.scores = {}
+        # Register start / stop with the app to follow changes to the file
+        self.reloader = Reloader('DTE', [location], self.load, self.apply)
+        self.reloader.reload_now()
 
-    def reload(self):
-        # self.log.debug('Reloading')
+    def load(self) -> dict[str, dict[str, float]]:
         with open(self.location) as f:
             scores = yaml.safe_load(f)
         # We need to ensure that all the usernames and keys are strings and all the values are floats
-        self.scores = {str(user): {str(k): float(v) for k, v in vals.items()} for user, vals in scores.items()}
+        return {str(user): {str(k): float(v) for k, v in vals.items()} for user, vals in scores.items()}
+
+    def apply(self, scores: dict[str, dict[str, float]]) -> None:
+        self.scores = scores
         self.log.debug(f'{self.name} is loading with {self.scores}')
 
 
 class NetworkTScP:
-    def __init__(self, data):
+    def __init__(self, data, feed: ChangeFeed, journal: Persistence | None = None):
         self.name = name = data['name']
+        self.feed = feed
+        self.journal = journal
         self.pull_endpoint = data.get('pull')
         self.log = logging.getLogger(f'TScP {name}')
         self.log.info(f'Starting Networked TScP')
-        self.scores = {}  # type: dict[str, dict[str, float]]
-        self.timers = {}  # type: dict[tuple[str, str], datetime]
-        self._lua = LuaRuntime()
-        self._globs = self._lua.globals()
+        # A user has the same row in the mapped and the internal scores
+        self.users = Interner()
+        self.scores = ScoreTable(self.users, SCORE_DTYPE)
+        # The internal (unmapped) scores as the TScP has them, deltas are applied on top of this
+        self.raw = ScoreTable(self.users)
+        self.version = None  # The last version of the TScP's table that we applied
+        self.sandbox = Sandbox('DTE')
+        self.mapping = MappingRegistry(name, self.sandbox.compile, self.sandbox.run)
         # Times
         self.old = timedelta(hours=1)
         self.stale = timedelta(hours=2)
+        self.expiry = ExpiryIndex(self.scores, self.old, self.stale)
+        self.heartbeat = None  # type: float | None
+        self._gardener = asyncio.create_task(self.gardener())
+        # Pulling on demand
+        self._pulls = {}  # type: dict[str, asyncio.Task]
+        self._pulled = {}  # type: dict[str, float]
+        self._pull_limit = asyncio.Semaphore(PULL_CONCURRENCY)
+        self._updating = asyncio.Lock()  # Updates are applied one after the other
 
     async def gardener(self):
+        """
+        Evict the scores that went stale, waking up when the next one is due
+        """
         while True:
-            await asyncio.sleep(10)
-            now = datetime.now()
-            rm = set()
-            old = []
-            for k, v in self.timers.items():
-                dt = v - now
-                if dt >= self.stale:
-                    k1, k2 = k
-                    self.scores[k1].pop(k2)
-                    rm.add(k)
-                elif dt >= self.old:
-                    old.append(k)
-            for k in rm:
-                self.timers.pop(k)
-
-    def update(self, data) -> None:
-        """
-        Take in the scores for all the users and update the scores and expiration timers accordingly
-        """
-        now = datetime.now()
-        mapping = None
-        if 'mapping' in data:
-            mapping = {}
-            for k, v in data['mapping'].items():
-                v = v.strip()
-                if v[:2] == '##':
-                    v = base64.b64decode(v[2:].encode()).decode()
-                function = v.split('\n', -1)
-                function[-1] = f'return {function[-1]}'
-                function = '\n'.join(function)
-                mapping[k] = self._lua.compile(function)
-
-        for user, user_scores in data['scores'].items():
-            if mapping:
-                normalized_scores = {}
-
-                # Go through the entire mapping table one at a time:
-                for mapping_key, function in mapping.items():
-                    # Wipe our lua runtime globals
-                    for k in self._globs.keys():
-                        del self._globs[k]
-
-                    # Inject the internal scoring into the lua interpreter
-                    self._globs['_score'] = data['scores']
-                    for k, v in user_scores.items():
-                        if re.match(r'\A[a-z][a-z0-9_]*\Z', k, flags=re.IGNORECASE):
-                            self._globs[k] = v
-                    
+            now = time.time()
+            for row, cols in self.expiry.expire(now, self._refreshed):
+                user = self.users.names[row]
+                values = self.scores.values[row, cols].tolist()
+                self.scores.clear(row, cols)
+                for col, value in zip(cols.tolist(), values):
+                    key = self.scores.keys.names[col]
+                    self.feed.publish(user, f'{self.name}:{key}', value, None)
+                    if self.journal is not None:
+                        self.journal.append(EVICT, self.name, user, key, 0.0, now)
+                self._release(row)
+            deadline = self.expiry.next_deadline()
+            delay = 10 if deadline is None else min(max(deadline - now, 0.1), 10)
+            await asyncio.sleep(delay)
+
+    def _release(self, row: int) -> None:
+        # Once a user has nothing left anywhere its row can go to someone else
+        if not self.scores.has_row(row) and not self.raw.has_row(row):
+            self.users.release(row)
+
+    def _raw_updated(self, rows: np.ndarray) -> np.ndarray:
+        """
+        When the internal scores of each of the rows were last written, in ms (0 for none)
+        """
+        out = np.zeros(len(rows), dtype=np.int64)
+        inside = rows < self.raw.updated.shape[0]
+        out[inside] = self.raw.updated[rows[inside]].max(axis=1, initial=0)
+        return out
+
+    def _covered(self, rows: np.ndarray, updated: np.ndarray) -> np.ndarray:
+        """
+        Which mapped scores, last written at `updated` (ms, one row of times per row or one time per row), the
+        heartbeat keeps fresh: those the TScP still has inputs for and that were written along with the latest of
+        them. A score that the mapping stopped giving is never rewritten, so it ages out from its own last update.
+        """
+        raw = self._raw_updated(rows)
+        if updated.ndim == 2:
+            raw = raw[:, None]
+        return (raw != 0) & (updated >= raw)
+
+    def _refreshed(self, rows: np.ndarray) -> np.ndarray:
+        # The heartbeat keeps everything fresh that the TScP still has, per score
+        updated = self.scores.updated[rows]
+        if self.heartbeat is None:
+            return np.full(updated.shape, -np.inf)
+        return np.where(self._covered(rows, updated), self.heartbeat, -np.inf)
+
+    def lookup(self, user: str, key: str, now: float) -> tuple[float | None, str | None, float | None]:
+        """
+        The (value, state, time it was last known to be fresh) of a score
+        """
+        row = self.users.get(user)
+        col = self.scores.keys.get(key)
+        if row is None or col is None:
+            return None, None, None
+        value, ts = self.scores.get(row, col)
+        if value is None:
+            return None, None, None
+        ts /= 1000
+        if self.heartbeat is not None and self.heartbeat > ts and self._covered(np.array([row]), self.scores.updated[[row], col])[0]:
+            ts = self.heartbeat
+        state = self.expiry.state(ts, now)
+        if state == STALE:
+            return None, state, ts  # The gardener has not gotten to it yet
+        return value, state, ts
+
+    async def pull(self, user: str, session: aiohttp.ClientSession) -> None:
+        """
+        Fetch the latest internal scores of a user from the TScP. Concurrent pulls of the same user share one request.
+        """
+        pending = self._pulls.get(user)
+        if pending is None:
+            now = time.time()
+            last = self._pulled.get(user)
+            if last is not None and now - last < PULL_BACKOFF:
+                return
+            if len(self._pulled) > 10000:
+                self._pulled = {u: t for u, t in self._pulled.items() if now - t < PULL_BACKOFF}
+            self._pulled[user] = now
+            pending = self._pulls[user] = asyncio.create_task(self._pull(user, session))
+            pending.add_done_callback(lambda _task: self._pulls.pop(user, None))
+        await asyncio.shield(pending)
+
+    async def _pull(self, user: str, session: aiohttp.ClientSession) -> None:
+        try:
+            async with self._pull_limit:
+                async with session.get(self.pull_endpoint, timeout=PULL_TIMEOUT, **request_args({'user': user})) as response:
+                    response.raise_for_status()
+                    user_scores = await read_response(response)
+        except Exception as e:
+            self.log.warning(f'Could not pull {user}, keeping the last known scores: {e!r}')
+            return
+        if user_scores:
+            # Not in the middle of a push that is being applied a batch at a time
+            async with self._updating:
+                now = time.time()
+                row = self.raw.row(user)
+                if row is not None:
+                    self.raw.clear(row)
+                rows = self.raw.set_many([(user, {str(k): float(v) for k, v in user_scores.items()})], to_ms(now))
+                self._score(rows, now)
+
+    async def update(self, data) -> dict:
+        """
+        Take in either the full table of scores or a delta against the version we last applied, update the scores
+        and expiration timers accordingly, and tell the TScP which version we are now at.
+        """
+        async with self._updating:
+            return await self._update(data)
+
+    async def _update(self, data) -> dict:
+        now = time.time()
+        if 'delta' in data:
+            base = data.get('base')
+            if base is None or base != self.version:
+                self.log.warning(f'Got a delta against version {base} but we are at {self.version}, asking for a resync')
+                return {'version': self.version, 'resync': True}
+            changed = self._apply_delta(data['delta'], data.get('removed') or {}, now)
+        else:
+            # A full push replaces what we know about the TScP, including the mapping when none is sent
+            changed = self._replace(data['scores'], now)
+
+        # Only the mapping entries that changed since the last push get compiled again
+        if 'mapping' in data or 'delta' not in data:
+            if self.mapping.update(data.get('mapping') or {}):
+                # The outputs of every user change with the mapping
+                changed = np.flatnonzero(self.raw.has_rows(np.arange(self.raw.rows)))
+
+        # Score a batch of users at a time so that lookups are answered while a large push is applied
+        for i in range(0, len(changed), SCORE_BATCH):
+            self._score(changed[i:i + SCORE_BATCH], now)
+            if len(changed) > SCORE_BATCH:
+                await asyncio.sleep(0)
+        self.heartbeat = now
+        self.version = data.get('version')
+        if len(changed):
+            self.log.info(f'Applied version {self.version} with {len(changed)} changed users')
+        return {'version': self.version}
+
+    def _replace(self, scores: dict[str, dict[str, float]], now: float) -> np.ndarray:
+        before = np.flatnonzero(self.raw.has_rows(np.arange(self.raw.rows)))
+        self.raw.clear(slice(None))
+        rows = self.raw.set_many(scores.items(), to_ms(now))
+        for row in np.setdiff1d(before, rows).tolist():
+            self._release(row)
+        return rows
+
+    def _apply_delta(self, delta: dict[str, dict[str, float]], removed: dict[str, list[str]], now: float) -> np.ndarray:
+        emptied = []
+        for user, keys in removed.items():
+            row = self.raw.row(user)
+            if row is None:
+                continue
+            cols = [c for c in map(self.raw.keys.get, keys) if c is not None]
+            self.raw.clear(row, cols)
+            emptied.append(row)
+        rows = self.raw.set_many(delta.items(), to_ms(now))
+        for row in emptied:
+            self._release(row)
+        return np.union1d(rows, np.array(emptied, dtype=np.intp))
+
+    def _score(self, rows: np.ndarray, now: float) -> None:
+        """
+        Run the mapping for the changed users and store the results. Scores that the mapping no longer gives a user
+        (its inputs were removed, or the key left the mapping) are evicted.
+        """
+        rows = rows[self.raw.has_rows(rows)] if len(rows) else rows
+        if not len(rows):
+            return
+        self._evict_unmapped(rows, self._map(rows, now), now)
+
+    def _map(self, rows: np.ndarray, now: float) -> dict[str, np.ndarray]:
+        """
+        Returns the rows that every mapped key was written for
+        """
+        written = {}  # type: dict[str, np.ndarray]
+        if not self.mapping.functions:
+            # Without a mapping the internal scores are the scores
+            for col, key in enumerate(self.raw.keys.names):
+                have = self.raw.updated[rows, col] != 0
+                if have.any():
+                    self._write(rows[have], key, self.raw.values[rows[have], col], now)
+                    written[key] = rows[have]
+            return written
+
+        def column(name: str) -> tuple[np.ndarray, np.ndarray]:
+            col = self.raw.keys.get(name)
+            if col is None:
+                return np.full(len(rows), np.nan), np.zeros(len(rows), dtype=bool)
+            return self.raw.values[rows, col], self.raw.updated[rows, col] != 0
+
+        # The arithmetic mapping functions are run over all of the users at once, the rest are left to lua
+        batch, lua_mapping = self.mapping.evaluate_batch(column, len(rows))
+        for mapping_key, (values, mask) in batch.items():
+            if mask.any():
+                self._write(rows[mask], mapping_key, values[mask], now)
+                written[mapping_key] = rows[mask]
+        if not lua_mapping:
+            return written
+
+        results = {mapping_key: ([], []) for mapping_key in lua_mapping}
+        score = RowView(self.raw)
+        with self.sandbox.runtime() as lua:
+            for row in rows.tolist():
+                user = self.users.names[row]
+                user_scores = self.raw.row_dict(row)
+
+                # The internal scoring of the user is the input to every function of the mapping table
+                inputs = {k: v for k, v in user_scores.items() if VARIABLE.match(k)}
+                inputs['_score'] = score
+                inputs = lua.inputs(inputs)
+
+                # Go through the rest of the mapping table one at a time:
+                for mapping_key, f in lua_mapping.items():
                     # Run the function
                     try:
-                        result = function()
+                        result = lua.run(f.function, inputs)
                     except Exception as e:
-                        self.log.error(f'Failed to perform mapping function for {k} on {user}: {e}')
+                        self.log.error(f'Failed to perform mapping function for {mapping_key} on {user}: {e}')
                         continue
 
                     # Interpret the response
                     if result is not None:
                         try:
-                            normalized_scores[mapping_key] = float(result)
+                            value = float(result)
                         except ValueError:
-                            self.log.error(f'The returned value for the policy "{k}" needs to be a nil response or a type convertible to a float. Got: {type(result)}.')
-            else:
-                normalized_scores = user_scores
+                            self.log.error(f'The returned value for the mapping "{mapping_key}" needs to be a nil response or a type convertible to a float. Got: {type(result)}.')
+                        else:
+                            results[mapping_key][0].append(row)
+                            results[mapping_key][1].append(value)
 
-            # Update the timers to the new values to be now
-            self.timers.setdefault(user, {}).update({k: now for k in normalized_scores.keys()})
+        for mapping_key, (result_rows, values) in results.items():
+            if result_rows:
+                written[mapping_key] = np.array(result_rows, dtype=np.intp)
+                self._write(written[mapping_key], mapping_key, np.array(values), now)
+        return written
 
-            # Update the scores for this user
-            self.scores.setdefault(user, {}).update(normalized_scores)
+    def _evict_unmapped(self, rows: np.ndarray, written: dict[str, np.ndarray], now: float) -> None:
+        names = self.users.names
+        rows = rows[rows < self.scores.updated.shape[0]]
+        for col, key in enumerate(self.scores.keys.names):
+            if key is None:
+                continue
+            have = rows[self.scores.updated[rows, col] != 0]
+            gone = np.setdiff1d(have, written.get(key, ()))
+            if not len(gone):
+                continue
+            values = self.scores.values[gone, col].tolist()
+            self.scores.clear(gone, col)
+            for row, value in zip(gone.tolist(), values):
+                self.feed.publish(names[row], f'{self.name}:{key}', value, None)
+                if self.journal is not None:
+                    self.journal.append(EVICT, self.name, names[row], key, 0.0, now)
+
+    def _write(self, rows: np.ndarray, key: str, values: np.ndarray, now: float) -> None:
+        """
+        Store one mapped key for the given users, and update the timers to the new values to be now
+        """
+        col = self.scores.column(key, create=True)
+        values = values.astype(self.scores.values.dtype, copy=False)
+        old, old_ts = self.scores.write(rows, col, values, to_ms(now))
+        self.expiry.touch(rows, now)
+
+        names = self.users.names
+        if self.feed.active:
+            changed = (old_ts == 0) | (old != values)
+            for row, was, new, had in zip(rows[changed].tolist(), old[changed].tolist(), values[changed].tolist(), old_ts[changed].tolist()):
+                self.feed.publish(names[row], f'{self.name}:{key}', was if had else None, new)
+        if self.journal is not None:
+            for row, value in zip(rows.tolist(), values.tolist()):
+                self.journal.append(SET, self.name, names[row], key, value, now)
+
+    def restore(self, user: str, key: str, value: float, ts: float) -> None:
+        row = self.scores.row(user, create=True)
+        col = self.scores.column(key, create=True)
+        self.scores.values[row, col] = value
+        self.scores.updated[row, col] = to_ms(ts)
+        self.expiry.touch(np.array([row]), ts)
+
+    def restore_many(self, users: list[str], user_index: np.ndarray, keys: list[str], key_index: np.ndarray,
+                     values: np.ndarray, updated: np.ndarray) -> None:
+        """
+        Restore a block of scores, given as indexes into the lists of users and keys
+        """
+        user_rows = self.scores.rows_for(users)
+        key_cols = np.array([self.scores.column(key, create=True) for key in keys], dtype=np.intp)
+        rows = user_rows[user_index]
+        self.scores.values[rows, key_cols[key_index]] = values
+        self.scores.updated[rows, key_cols[key_index]] = updated
+        # Everything gets looked at by the gardener once, which then schedules it properly
+        self.expiry.touch(user_rows, 0)
+
+    def forget(self, user: str, key: str) -> None:
+        row = self.scores.row(user)
+        col = self.scores.column(key)
+        if row is not None and col is not None:
+            self.scores.clear(row, col)
+            self._release(row)
+
+    def snapshot(self) -> tuple[list[str | None], list[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        All the scores that we hold as (users, keys, rows, columns, values, last update in ms)
+        """
+        rows, cols = self.scores.present()
+        updated = self.scores.updated[rows, cols]
+        if self.heartbeat is not None:
+            covered = self._covered(rows, updated)
+            updated = np.where(covered, np.maximum(updated, to_ms(self.heartbeat)), updated)
+        return self.users.names, self.scores.keys.names, rows, cols, self.scores.values[rows, cols], updated
+
+    def status(self) -> dict:
+        now = time.time()
+        return {
+            'pull': self.pull_endpoint,
+            'users': self.scores.count_rows(),
+            'version': self.version,
+            'expiry': self.expiry.counts(now, self._refreshed),
+            'memory': self.scores.nbytes() + self.raw.nbytes(),
+            'mapping': self.mapping.describe(),
+            'lua': self.sandbox.metrics(),
+        }
 
 class DTE:
     def __init__(self):
         self.log = logging.getLogger('DTE')
         self.log.debug('Starting DTE')
         self.tscps = {}
+        self.feed = ChangeFeed()
+        self.session = None  # type: aiohttp.ClientSession | None
+        # Keep the scores across restarts when given somewhere to put them
+        data = os.environ.get('DTE_DATA')
+        self.persistence = Persistence(data) if data else None
 
-    def tscp_changed(self, path):
-        for tscp in self.tscps.values():
-            if path.endswith(tscp.location):
-                tscp.reload()
-                return
+    async def start(self, _app) -> None:
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=100, limit_per_host=PULL_CONCURRENCY))
+        if self.persistence is not None:
+            self.restore()
+            self.persistence.start(self._persisted_state)
 
-    def get(self, user: str, keys: Iterable[str]) -> dict[str, float]:
-        out = {}
-        for key in keys:
-            tscp_name, score_key = key.split(':', 1)
-            tscp = self.tscps.get(tscp_name)
-            if not tscp:
-                continue
-            out[key] = tscp.scores.get(user, {}).get(score_key)
+    async def stop(self, _app) -> None:
+        if self.session is not None:
+            await self.session.close()
+        if self.persistence is not None:
+            await self.persistence.stop()
+
+    def restore(self) -> None:
+        """
+        Bring back the scores from before a restart. The TScPs will be asked for a full resync on their next push,
+        since we do not know what version of their scores this is.
+        """
+        snapshot = self.persistence.load_snapshot()
+        if snapshot is not None:
+            meta, strings, entries = snapshot
+            for name, pull in meta.get('tscps', {}).items():
+                self._restored_tscp(name).pull_endpoint = pull or None
+            for t in np.unique(entries['tscp']).tolist():
+                block = entries[entries['tscp'] == t]
+                users, user_index = np.unique(block['user'], return_inverse=True)
+                keys, key_index = np.unique(block['key'], return_inverse=True)
+                self._restored_tscp(strings[t]).restore_many(
+                    [strings[u] for u in users.tolist()], user_index,
+                    [strings[k] for k in keys.tolist()], key_index,
+                    block['value'], block['ts'],
+                )
+        for kind, name, user, key, value, ts in self.persistence.load_wal():
+            if kind == ONRAMP:
+                self._restored_tscp(name).pull_endpoint = user or None
+            elif kind == SET:
+                self._restored_tscp(name).restore(user, key, value, ts)
+            elif kind == EVICT:
+                self._restored_tscp(name).forget(user, key)
+        self.log.info(f'Restored {sum(len(t.scores) for t in self.tscps.values())} scores')
+
+    def _restored_tscp(self, name: str) -> NetworkTScP:
+        tscp = self.tscps.get(name)
+        if tscp is None:
+            tscp = self.tscps[name] = NetworkTScP({'name': name, 'pull': None}, self.feed, self.persistence)
+        return tscp
+
+    def _persisted_state(self):
+        meta = {'tscps': {name: tscp.pull_endpoint for name, tscp in self.tscps.items()}}
+        blocks = [(name, *tscp.snapshot()) for name, tscp in self.tscps.items()]
+        return blocks, meta
+
+    def get(self, user: str, keys: Iterable[str], detail: bool = False) -> dict:
+        """
+        With `detail` every key also reports whether the score is live or old, and when it was last known to be fresh
+        """
+        return self.get_many([(user, keys)], detail)[0]
+
+    def get_many(self, queries: Sequence[tuple[str, Iterable[str]]], detail: bool = False) -> list[dict]:
+        """
+        Look up many (user, keys) at once, every key is only split once and every TScP visited once
+        """
+        now = time.time()
+        parsed = {}  # type: dict[str, tuple[str, str]]
+        by_tscp = {}  # type: dict[str, list[tuple[dict, str, str, str]]]
+        out = []
+        for user, keys in queries:
+            got = {}
+            out.append(got)
+            for key in keys:
+                split = parsed.get(key)
+                if split is None:
+                    split = parsed[key] = tuple(key.split(':', 1))
+                tscp_name, score_key = split
+                if tscp_name not in self.tscps:
+                    continue
+                got[key] = None  # Keeps the order of the keys in the response
+                by_tscp.setdefault(tscp_name, []).append((got, user, key, score_key))
+
+        for tscp_name, lookups in by_tscp.items():
+            lookup = self.tscps[tscp_name].lookup
+            for got, user, key, score_key in lookups:
+                value, state, ts = lookup(user, score_key, now)
+                got[key] = {'value': value, 'state': state, 'updated': ts} if detail else value
         return out
 
+    async def fetch_many(self, queries: Sequence[tuple[str, Iterable[str]]], detail: bool = False) -> list[dict]:
+        """
+        Like get_many, but scores that are missing or no longer live are first pulled from the TScPs that allow it
+        """
+        if self.session is not None:
+            now = time.time()
+            wanted = {}  # type: dict[str, set[str]]
+            for user, keys in queries:
+                for key in keys:
+                    tscp_name, score_key = key.split(':', 1)
+                    tscp = self.tscps.get(tscp_name)
+                    if tscp is None or not tscp.pull_endpoint:
+                        continue
+                    _value, state, _ts = tscp.lookup(user, score_key, now)
+                    if state != LIVE:
+                        wanted.setdefault(tscp_name, set()).add(user)
+            if wanted:
+                await asyncio.gather(*(
+                    self.tscps[tscp_name].pull(user, self.session)
+                    for tscp_name, users in wanted.items()
+                    for user in users
+                ))
+        return self.get_many(queries, detail)
+
     def onramp(self, tscp) -> None:
         name = tscp['name']
         if name in self.tscps:
-            self.tscps.pull = tscp.get('pull')
+            self.tscps[name].pull_endpoint = tscp.get('pull')
         else:
-            new_tscp = NetworkTScP(tscp)
+            new_tscp = NetworkTScP(tscp, self.feed, self.persistence)
             self.tscps[new_tscp.name] = new_tscp
+        if self.persistence is not None:
+            self.persistence.append(ONRAMP, name, tscp.get('pull') or '', '', 0.0, time.time())
 
-    def update(self, data) -> None:
+    async def update(self, data) -> dict:
         name = data['name']
         if name not in self.tscps:
             self.onramp({'name': name, 'pull': None})
-        self.tscps[name].update(data)
+        return await self.tscps[name].update(data)
 
 dte = DTE()
 
 @routes.get('/get')
 async def get_trust_scores(request):
     try:
-        body = await request.json()
+        body = await read(request)
         user = body['user']
         keys = body['keys']
+        detail = bool(body.get('detail', False))
     except:
         raise web.HTTPBadRequest()
-    got = dte.get(user, keys)
-    return web.json_response(got)
+    got = (await dte.fetch_many([(user, keys)], detail))[0]
+    return respond(request, got)
+
+@routes.post('/bulk')
+async def bulk_get_trust_scores(request):
+    """
+    Either {"queries": [{"user": ..., "keys": [...]}, ...]} or {"users": [...], "keys": [...]} for the same keys.
+    The results are in the same order as the queries. Asking for application/x-ndjson streams one line per query.
+    """
+    try:
+        body = await read(request)
+        if 'queries' in body:
+            queries = [(q['user'], q['keys']) for q in body['queries']]
+        else:
+            keys = body['keys']
+            queries = [(user, keys) for user in body['users']]
+        detail = bool(body.get('detail', False))
+    except:
+        raise web.HTTPBadRequest()
+
+    if 'application/x-ndjson' not in request.headers.get('Accept', ''):
+        return respond(request, {'results': await dte.fetch_many(queries, detail)})
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    chunk = 1000
+    for i in range(0, len(queries), chunk):
+        batch = queries[i:i + chunk]
+        got = await dte.fetch_many(batch, detail)  # Pulls what is missing or no longer live, like the JSON answer
+        lines = ''.join(json.dumps({'user': user, 'scores': scores}) + '\n' for (user, _keys), scores in zip(batch, got))
+        await response.write(lines.encode())
+    await response.write_eof()
+    return response
+
+# The change feed is served the same way by a single DTE and by the router in front of the shards
+feed_routes = web.RouteTableDef()
+
+@feed_routes.get('/subscribe')
+async def subscribe(request):
+    """
+    A websocket change feed. The client sends {"users": [...], "keys": ["near:network:*", ...]} at any time to set
+    what it is interested in, and gets back lists of {"user", "key", "old", "new", "time"} events.
+    If the client falls behind and events were dropped, a {"resync": true} message is sent before the next batch.
+    """
+    feed = request.app['feed']  # type: ChangeFeed
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    sub = feed.subscribe()
+
+    async def sender():
+        while True:
+            events, lost = await sub.next()
+            if lost:
+                await ws.send_json({'resync': True})
+            await ws.send_json(events)
+    task = asyncio.create_task(sender())
+    try:
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                try:
+                    interest = json.loads(msg.data)
+                    sub.set_interest(interest.get('users', ()), interest.get('keys', ()))
+                except Exception as e:
+                    await ws.send_json({'error': f'Invalid subscription: {e}'})
+            elif msg.type == aiohttp.WSMsgType.ERROR:
+                root.error(f'Subscriber connection closed with exception: {ws.exception()}')
+    finally:
+        task.cancel()
+        feed.unsubscribe(sub)
+    return ws
+
+@feed_routes.get('/events')
+async def events(request):
+    """
+    The same change feed as server-sent events, e.g. /events?user=<user>&key=near:*
+    """
+    feed = request.app['feed']  # type: ChangeFeed
+    sub = feed.subscribe(request.query.getall('user', []), request.query.getall('key', []))
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    try:
+        await response.prepare(request)
+        while True:
+            events, lost = await sub.next()
+            if lost:
+                await response.write(b'event: resync\ndata: {}\n\n')
+            await response.write(f'data: {json.dumps(events)}\n\n'.encode())
+    finally:
+        feed.unsubscribe(sub)
+
+@routes.get('/status')
+async def status(request):
+    return respond(request, {name: tscp.status() for name, tscp in dte.tscps.items()})
+
+@routes.get('/health')
+async def health(request):
+    return web.json_response({'shard': os.environ.get('DTE_SHARD'), 'tscps': len(dte.tscps)})
 
 @routes.get('/onramp')
+@routes.post('/onramp')
 async def onramp(request):
     root.info('On-ramping TScP')
-    body = await request.json()
+    body = await read(request)
     dte.onramp(body)
-    return web.json_response(True)
+    return respond(request, True)
 
 @routes.post('/update')
 async def update_trust_scores(request):
     root.info('Got update from tscp')
-    body = await request.json()
-    dte.update(body)
-    return web.json_response(True)
+    body = await read(request)
+    return respond(request, await dte.update(body))
+
+def main():
+    port = int(os.environ.get('PORT', 9991))
+    shards = int(os.environ.get('DTE_SHARDS', 1))
+    if shards > 1:
+        # A router on our port in front of worker processes on the ports after it, each owning part of the users
+        from shard import Router, router_app
+        router = Router(shards, port + 1, os.environ.get('DTE_DATA'))
+        app = router_app(router, feed_routes, MAX_BODY)
+    else:
+        app = web.Application(client_max_size=MAX_BODY)
+        app.add_routes(routes)
+        app.add_routes(feed_routes)
+        app['feed'] = dte.feed
+        app.on_startup.append(dte.start)
+        app.on_cleanup.append(dte.stop)
+    web.run_app(app, port=port)
 
-app = web.Application()
-app.add_routes(routes)
-web.run_app(app, port=9991)
+if __name__ == '__main__':
+    main()
 
@@ -0,0 +1,286 @@
+# This file is part of DTE-ERAU. Copyright 2023 Embry-Riddle Aeronautical University
+#
+# DTE-ERAU is free software: you can redistribute it and/or modify it under the terms of the GNU 
+# General Public License as published by the Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# DTE-ERAU is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. 
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with DTE-ERAU. If not, see 
+# <https://www.gnu.org/licenses/>. 
+
+import base64
+import hashlib
+import logging
+import numpy as np
+import re
+from dataclasses import dataclass
+from sandbox import Chunk
+from typing import Any, Callable, Optional
+
+# Only these names get injected into the lua globals for a user, so they are the only ones we can vectorize
+VARIABLE = re.compile(r'\A[a-z][a-z0-9_]*\Z', flags=re.IGNORECASE)
+LUA_KEYWORDS = {
+    'and', 'break', 'do', 'else', 'elseif', 'end', 'false', 'for', 'function', 'goto', 'if', 'in',
+    'local', 'nil', 'not', 'or', 'repeat', 'return', 'then', 'true', 'until', 'while',
+}
+_TOKEN = re.compile(r'\s*(?:(\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?)|([A-Za-z_][A-Za-z0-9_]*)|(//|[-+*/%^()]))')
+
+
+def decode_source(source: str) -> str:
+    """
+    Mapping functions can be sent as plain lua or as base64 prefixed with "##"
+    """
+    source = source.strip()
+    if source[:2] == '##':
+        source = base64.b64decode(source[2:].encode()).decode()
+    return source
+
+
+def to_chunk(source: str) -> str:
+    """
+    The last line of a mapping function is the value that it evaluates to
+    """
+    function = source.split('\n', -1)
+    function[-1] = f'return {function[-1]}'
+    return '\n'.join(function)
+
+
+class VectorExpression:
+    """
+    A mapping function that is nothing more than arithmetic over the internal scores, such as `0.9 * b + 0.1 * a`.
+    These are evaluated with numpy over the columns of every user at once instead of once per user in lua.
+    """
+    def __init__(self, source: str):
+        self.source = source
+        self.names = set()  # type: set[str]
+        self._tokens = self._tokenize(source)
+        self._pos = 0
+        self._evaluate = self._expr()
+        if self._pos != len(self._tokens):
+            raise SyntaxError(f'Unexpected {self._tokens[self._pos][1]!r}')
+        if not self.names:
+            raise SyntaxError('Constant expressions are left to lua')
+
+    @classmethod
+    def compile(cls, source: str) -> Optional['VectorExpression']:
+        """
+        Returns None when the source uses anything beyond the arithmetic subset that we understand
+        """
+        try:
+            return cls(source)
+        except SyntaxError:
+            return None
+
+    def evaluate(self, columns: dict[str, np.ndarray]) -> np.ndarray:
+        with np.errstate(all='ignore'):
+            return self._evaluate(columns)
+
+    @staticmethod
+    def _tokenize(source: str) -> list[tuple[str, str]]:
+        if '\n' in source:
+            raise SyntaxError('Multi-line mapping functions are left to lua')
+        if '--' in source:
+            # A comment (or --[[ ]] block) in lua, not two minus signs. Nothing in the subset needs two in a row.
+            raise SyntaxError('Comments are left to lua')
+        tokens = []
+        pos = 0
+        source = source.rstrip()
+        while pos < len(source):
+            m = _TOKEN.match(source, pos)
+            if m is None:
+                raise SyntaxError(f'Unexpected character at {pos}')
+            number, name, op = m.groups()
+            if number is not None:
+                tokens.append(('number', number))
+            elif name is not None:
+                if name in LUA_KEYWORDS or not VARIABLE.match(name):
+                    raise SyntaxError(f'Unsupported name {name}')
+                tokens.append(('name', name))
+            elif op == '//':
+                raise SyntaxError('Floor division is left to lua')
+            else:
+                tokens.append(('op', op))
+            pos = m.end()
+        return tokens
+
+    def _peek(self) -> Optional[str]:
+        if self._pos < len(self._tokens):
+            kind, value = self._tokens[self._pos]
+            if kind == 'op':
+                return value
+        return None
+
+    def _next(self) -> tuple[str, str]:
+        if self._pos >= len(self._tokens):
+            raise SyntaxError('Unexpected end of expression')
+        token = self._tokens[self._pos]
+        self._pos += 1
+        return token
+
+    # The grammar follows the lua operator precedence: + - < * / % < unary - < ^ (right associative)
+    def _expr(self):
+        left = self._term()
+        while (op := self._peek()) in ('+', '-'):
+            self._pos += 1
+            right = self._term()
+            if op == '+':
+                left = (lambda a, b: lambda c: a(c) + b(c))(left, right)
+            else:
+                left = (lambda a, b: lambda c: a(c) - b(c))(left, right)
+        return left
+
+    def _term(self):
+        left = self._unary()
+        while (op := self._peek()) in ('*', '/', '%'):
+            self._pos += 1
+            right = self._unary()
+            if op == '*':
+                left = (lambda a, b: lambda c: a(c) * b(c))(left, right)
+            elif op == '/':
+                left = (lambda a, b: lambda c: np.true_divide(a(c), b(c)))(left, right)
+            else:
+                left = (lambda a, b: lambda c: np.mod(a(c), b(c)))(left, right)
+        return left
+
+    def _unary(self):
+        if self._peek() == '-':
+            self._pos += 1
+            operand = self._unary()
+            return lambda c: -operand(c)
+        return self._power()
+
+    def _power(self):
+        base = self._atom()
+        if self._peek() == '^':
+            self._pos += 1
+            exponent = self._unary()
+            return lambda c: np.power(base(c), exponent(c))
+        return base
+
+    def _atom(self):
+        kind, value = self._next()
+        if kind == 'number':
+            number = float(value)
+            return lambda c: number
+        if kind == 'name':
+            self.names.add(value)
+            return lambda c: c[value]
+        if value == '(':
+            inner = self._expr()
+            if self._next() != ('op', ')'):
+                raise SyntaxError('Expected )')
+            return inner
+        raise SyntaxError(f'Unexpected {value!r}')
+
+
+@dataclass
+class MappingFunction:
+    key: str
+    digest: str
+    source: str
+    function: Chunk
+    vector: Optional[VectorExpression] = None
+
+
+class MappingRegistry:
+    """
+    The compiled mapping functions of a single TScP, keyed by the hash of the source that was pushed to us.
+    Only the mapping keys whose source changed since the last push get recompiled.
+    When given a way to `run` chunks, every vectorized function is checked against lua once when it is compiled, and
+    left to lua if they do not agree.
+    """
+    def __init__(self, name: str, compile: Callable[[str], Chunk], run: Optional[Callable[[Chunk, dict], Any]] = None):
+        self.log = logging.getLogger(f'Mapping {name}')
+        self._compile = compile
+        self._run = run
+        self.functions = {}  # type: dict[str, MappingFunction]
+        self.version = None  # type: str | None
+        self.compiled = 0
+
+    def update(self, mapping: dict[str, str]) -> bool:
+        """
+        Bring the registry up to date with the pushed mapping, returns True if anything changed
+        """
+        functions = {}
+        for key, source in mapping.items():
+            digest = hashlib.sha1(source.encode()).hexdigest()
+            current = self.functions.get(key)
+            if current is not None and current.digest == digest:
+                functions[key] = current
+                continue
+            # Only compile the entries that are new or changed. If this fails we keep the old table as a whole.
+            code = decode_source(source)
+            function = self._compile(to_chunk(code))
+            vector = VectorExpression.compile(code)
+            if vector is not None and self._run is not None and not self._agrees(vector, function):
+                self.log.warning(f'The numpy and lua results for {key} differ, leaving it to lua')
+                vector = None
+            functions[key] = MappingFunction(
+                key=key,
+                digest=digest,
+                source=code,
+                function=function,
+                vector=vector,
+            )
+            self.compiled += 1
+            backend = 'numpy' if vector else 'lua'
+            self.log.info(f'Compiled mapping for {key} ({digest[:8]}, {backend})')
+
+        version = self._version(functions)
+        changed = version != self.version
+        self.functions = functions
+        self.version = version
+        return changed
+
+    def _agrees(self, vector: VectorExpression, function: Chunk) -> bool:
+        """
+        Whether the vectorized function gives what lua does, for some inputs that are neither integers nor equal
+        """
+        probe = {name: 1.25 + 0.5 * i for i, name in enumerate(sorted(vector.names))}
+        try:
+            expected = float(self._run(function, probe))
+        except Exception:
+            return False
+        got = vector.evaluate({name: np.array([value]) for name, value in probe.items()})
+        return bool(np.isclose(np.broadcast_to(got, (1,))[0], expected, rtol=1e-9, equal_nan=True))
+
+    @staticmethod
+    def _version(functions: dict[str, MappingFunction]) -> str | None:
+        if not functions:
+            return None
+        h = hashlib.sha1()
+        for key in sorted(functions):
+            h.update(f'{key}\0{functions[key].digest}\0'.encode())
+        return h.hexdigest()
+
+    def evaluate_batch(self, column: Callable[[str], tuple[np.ndarray, np.ndarray]], n: int) -> tuple[dict[str, tuple[np.ndarray, np.ndarray]], dict[str, MappingFunction]]:
+        """
+        Run every vectorizable mapping function over n users at once. `column` gives the values of an internal score
+        for those users, and whether each of them has it.
+        Returns the results (values, mask of users that had every input) and the functions still left to lua.
+        """
+        results = {}
+        remaining = {}
+        columns = {}  # type: dict[str, np.ndarray]
+        present = {}  # type: dict[str, np.ndarray]
+        for key, f in self.functions.items():
+            if f.vector is None:
+                remaining[key] = f
+                continue
+            for name in f.vector.names - columns.keys():
+                columns[name], present[name] = column(name)
+            values = np.broadcast_to(f.vector.evaluate(columns), (n,)).astype(np.float64)
+            mask = np.logical_and.reduce([present[name] for name in f.vector.names])
+            results[key] = (values, mask)
+        return results, remaining
+
+    def describe(self) -> dict:
+        return {
+            'version': self.version,
+            'compiled': self.compiled,
+            'keys': {k: f.digest for k, f in self.functions.items()},
+            'backends': {k: 'numpy' if f.vector else 'lua' for k, f in self.functions.items()},
+        }
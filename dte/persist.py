@@ -0,0 +1,224 @@
+# This file is part of DTE-ERAU. Copyright 2023 Embry-Riddle Aeronautical University
+#
+# DTE-ERAU is free software: you can redistribute it and/or modify it under the terms of the GNU 
+# General Public License as published by the Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# DTE-ERAU is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. 
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with DTE-ERAU. If not, see 
+# <https://www.gnu.org/licenses/>. 
+
+import asyncio
+import glob
+import json
+import logging
+import mmap
+import numpy as np
+import os
+import re
+import struct
+import time
+from typing import Callable, Iterable, Iterator, Optional
+
+# Kinds of records
+SET = 1  # A score was written
+EVICT = 2  # A score went stale and was removed
+ONRAMP = 3  # A TScP registered, the user field holds its pull endpoint
+
+# Snapshot: header, the interned strings separated by NUL, a json blob of metadata, padding, then the entries
+SNAPSHOT_MAGIC = b'DTESNAP2'
+SNAPSHOT_HEADER = struct.Struct('<8sQQQQ')  # magic, wal generation, strings size, metadata size, number of entries
+ENTRY = np.dtype([('tscp', '<u4'), ('user', '<u4'), ('key', '<u4'), ('value', '<f8'), ('ts', '<i8')])  # ts in ms
+
+# Write-ahead log: a fixed header per record followed by the utf-8 strings
+RECORD = struct.Struct('<BddHHH')  # kind, ts, value, len(tscp), len(user), len(key)
+
+# (kind, tscp, user, key, value, ts)
+Record = tuple[int, str, str, str, float, float]
+
+# The scores of one TScP: (name, users, keys, rows, columns, values, ts in ms) with rows and columns indexing the
+# lists of users and keys
+Block = tuple[str, list[Optional[str]], list[Optional[str]], np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
+class Persistence:
+    """
+    Keeps an append-only log of the scores that DTE applies, plus periodic snapshots of all of them, so that a
+    restarted DTE comes back with the scores (and their original timestamps) it had.
+
+    Every snapshot starts a new log generation, and the logs from before a snapshot are removed once it is written.
+    """
+    def __init__(self, directory: str, interval: float = 60, flush_interval: float = 1):
+        self.log = logging.getLogger('Persistence')
+        self.directory = directory
+        self.interval = interval
+        self.flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+        self.generation = 0
+        self.records = 0  # Since the last snapshot
+        self._wal = None
+        self._buffer = bytearray()
+        self._task = None  # type: asyncio.Task | None
+
+    @property
+    def snapshot_path(self) -> str:
+        return os.path.join(self.directory, 'snapshot.bin')
+
+    def _wal_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f'wal.{generation:08d}.log')
+
+    def _wal_generations(self) -> list[int]:
+        generations = []
+        for path in glob.glob(os.path.join(self.directory, 'wal.*.log')):
+            m = re.search(r'wal\.(\d+)\.log$', path)
+            if m:
+                generations.append(int(m.group(1)))
+        return sorted(generations)
+
+    def load_snapshot(self) -> Optional[tuple[dict, list[str], np.ndarray]]:
+        """
+        The last snapshot as (metadata, strings, entries), where the entries index into the strings
+        """
+        self.generation = 0
+        if not os.path.exists(self.snapshot_path):
+            return None
+        start = time.time()
+        with open(self.snapshot_path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, generation, strings_size, meta_size, n = SNAPSHOT_HEADER.unpack_from(mm, 0)
+        if magic != SNAPSHOT_MAGIC:
+            mm.close()
+            self.log.warning(f'Ignoring {self.snapshot_path}, it is not a snapshot of this version of DTE')
+            return None
+        offset = SNAPSHOT_HEADER.size
+        strings = mm[offset:offset + strings_size].decode().split('\0')
+        offset += strings_size
+        meta = json.loads(mm[offset:offset + meta_size])
+        offset += meta_size
+        offset += -offset % 8
+        entries = np.frombuffer(mm, dtype=ENTRY, count=n, offset=offset).copy()
+        mm.close()
+        self.generation = generation + 1
+        self.log.info(f'Loaded a snapshot of {n} scores in {time.time() - start:.3f}s')
+        return meta, strings, entries
+
+    def load_wal(self) -> Iterator[Record]:
+        """
+        Everything that was logged since the snapshot, in the order it has to be applied
+        """
+        generation = self.generation
+        count = 0
+        for wal in self._wal_generations():
+            if wal < generation:
+                continue
+            for record in self._load_wal(self._wal_path(wal)):
+                count += 1
+                yield record
+            generation = wal + 1
+        self.generation = generation
+        self.log.info(f'Loaded {count} records from the log')
+
+    def _load_wal(self, path: str) -> Iterator[Record]:
+        with open(path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            kind, ts, value, a, b, c = RECORD.unpack_from(data, offset)
+            end = offset + RECORD.size + a + b + c
+            if end > len(data):
+                break  # Cut off in the middle of a write
+            base = offset + RECORD.size
+            tscp = data[base:base + a].decode()
+            user = data[base + a:base + a + b].decode()
+            key = data[base + a + b:end].decode()
+            yield kind, tscp, user, key, value, ts
+            offset = end
+        if offset != len(data):
+            self.log.warning(f'Ignoring {len(data) - offset} bytes at the end of {path}')
+
+    def append(self, kind: int, tscp: str, user: str, key: str, value: float, ts: float) -> None:
+        t, u, k = tscp.encode(), user.encode(), key.encode()
+        self._buffer += RECORD.pack(kind, ts, value, len(t), len(u), len(k))
+        self._buffer += t + u + k
+        self.records += 1
+
+    def flush(self) -> None:
+        if self._buffer and self._wal is not None:
+            self._wal.write(self._buffer)
+            self._wal.flush()
+            self._buffer.clear()
+
+    def start(self, state: Callable[[], tuple[Iterable[Block], dict]]) -> None:
+        """
+        Start logging to a new generation and take snapshots of `state`, which returns a block of scores per TScP
+        and the metadata of the TScPs
+        """
+        self._wal = open(self._wal_path(self.generation), 'ab')
+        self._task = asyncio.create_task(self._run(state))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        self.flush()
+        if self._wal is not None:
+            self._wal.close()
+
+    async def _run(self, state) -> None:
+        last = time.time()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if self.records and time.time() - last >= self.interval:
+                    await self.snapshot(*state())
+                    last = time.time()
+            except Exception as e:
+                self.log.error(f'Could not persist the scores: {e!r}')
+
+    async def snapshot(self, blocks: Iterable[Block], meta: dict) -> None:
+        # The snapshot holds everything up to now, so anything after goes in the next generation of the log
+        self.flush()
+        self._wal.close()
+        self.generation += 1
+        self._wal = open(self._wal_path(self.generation), 'ab')
+        self.records = 0
+        blob = self._encode_snapshot(blocks, meta, self.generation - 1)
+        await asyncio.get_running_loop().run_in_executor(None, self._write_snapshot, blob)
+        for generation in self._wal_generations():
+            if generation < self.generation:
+                os.remove(self._wal_path(generation))
+
+    @staticmethod
+    def _encode_snapshot(blocks: Iterable[Block], meta: dict, generation: int) -> bytes:
+        strings = []  # type: list[str]
+        arrays = []
+        for name, users, keys, rows, cols, values, ts in blocks:
+            array = np.empty(len(rows), dtype=ENTRY)
+            array['tscp'] = len(strings)
+            strings.append(name)
+            array['user'] = rows + len(strings)
+            strings.extend(user or '' for user in users)
+            array['key'] = cols + len(strings)
+            strings.extend(key or '' for key in keys)
+            array['value'] = values
+            array['ts'] = ts
+            arrays.append(array)
+        array = np.concatenate(arrays) if arrays else np.empty(0, dtype=ENTRY)
+        strings = '\0'.join(strings).encode()
+        meta = json.dumps(meta).encode()
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, generation, len(strings), len(meta), len(array))
+        body = header + strings + meta
+        return body + b'\0' * (-len(body) % 8) + array.tobytes()
+
+    def _write_snapshot(self, blob: bytes) -> None:
+        start = time.time()
+        tmp = self.snapshot_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+        self.log.info(f'Wrote a snapshot of {len(blob)} bytes in {time.time() - start:.3f}s')
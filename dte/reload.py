@@ -0,0 +1,202 @@
+# This file is part of DTE-ERAU. Copyright 2023 Embry-Riddle Aeronautical University
+#
+# DTE-ERAU is free software: you can redistribute it and/or modify it under the terms of the GNU 
+# General Public License as published by the Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# DTE-ERAU is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. 
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with DTE-ERAU. If not, see 
+# <https://www.gnu.org/licenses/>. 
+
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import traceback
+from typing import Any, Callable, Iterable, Optional
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+# Only inotify tells when a writer closed the file it wrote. Elsewhere a file counts as written once its size and
+# modification time stop changing.
+CLOSE_EVENTS = Observer.__name__ == 'InotifyObserver'
+
+
+class _Handler(FileSystemEventHandler):
+    def __init__(self, paths: set[str], callback: Callable[[bool], None]):
+        self.paths = paths
+        self.callback = callback  # Called with whether the file was written to the end
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        if event.event_type == 'closed':
+            path, finished = event.src_path, True
+        elif event.event_type == 'moved':
+            path, finished = event.dest_path, True  # Editors and exports often write a new file and rename it over
+        elif event.event_type in ('modified', 'created') and not CLOSE_EVENTS:
+            path, finished = event.src_path, False
+        else:
+            return
+        if os.path.abspath(path) in self.paths:
+            self.callback(finished)
+
+
+class Reloader:
+    """
+    Reloads a configuration when its files change. The watchdog thread only notes that a file was written; a burst of
+    events (an editor fires several per save) is coalesced into one reload once the files have been quiet for a while.
+    A file is only read once its writer is done with it, when it was closed or renamed into place, so a large file
+    that takes a while to write is not loaded half way. `load` reads and compiles the files on a worker thread, and
+    `apply` swaps the result in on the event loop. Nothing is loaded when the files hold the same bytes as last time,
+    and a failed load keeps what was applied before. Configured from the environment with the given prefix:
+
+        <PREFIX>_RELOAD_DELAY      seconds the files must be quiet before reloading (default 0.2)
+    """
+    def __init__(self, prefix: str, paths: Iterable[Optional[str]], load: Callable[[], Any], apply: Callable[[Any], None]):
+        self.log = logging.getLogger(f'Reloader {prefix}')
+        self.paths = {os.path.abspath(path) for path in paths if path}
+        self.load = load
+        self.apply = apply
+        self.delay = float(os.environ.get(f'{prefix}_RELOAD_DELAY', 0.2))
+        self.digest = None  # type: bytes | None  # Of the files that were last applied
+        self.generation = 0  # Goes up with every reload that was applied
+        self._loop = None  # type: asyncio.AbstractEventLoop | None
+        self._observer = None
+        self._timer = None  # type: asyncio.TimerHandle | None
+        self._writing = None  # type: tuple | None  # Size and time of the files while they may still be written to
+        self._task = None  # type: asyncio.Task | None
+        self._again = False  # Something changed while reloading
+        # Metrics
+        self.events = 0
+        self.reloads = 0
+        self.skipped = 0
+        self.failed = 0
+        self.duration = 0.0  # Of the last reload
+
+    async def start(self, _app=None) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._observer = Observer()
+        handler = _Handler(self.paths, lambda finished: self._loop.call_soon_threadsafe(self._changed, finished))
+        for directory in {os.path.dirname(path) for path in self.paths}:
+            self._observer.schedule(handler, path=directory)
+        self._observer.start()
+
+    async def stop(self, _app=None) -> None:
+        if self._observer is not None:
+            self._observer.stop()
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._task is not None:
+            self._task.cancel()
+
+    def reload_now(self) -> bool:
+        """
+        Reload right away on the calling thread, for the first load before the event loop runs.
+        Returns False when nothing was applied.
+        """
+        try:
+            loaded = self._load()
+            if loaded is not None:
+                self._apply(*loaded)
+                return True
+        except Exception:
+            self._failed()
+        return False
+
+    def _changed(self, finished: bool) -> None:
+        self.events += 1
+        if self._timer is not None:
+            self._timer.cancel()
+        self._writing = None if finished else self._stat()
+        self._timer = self._loop.call_later(self.delay, self._fire)
+
+    def _stat(self) -> tuple:
+        stats = []
+        for path in sorted(self.paths):
+            try:
+                st = os.stat(path)
+                stats.append((st.st_size, st.st_mtime_ns))
+            except FileNotFoundError:
+                stats.append(None)
+        return tuple(stats)
+
+    def _fire(self) -> None:
+        self._timer = None
+        if self._writing is not None:
+            writing = self._stat()
+            if writing != self._writing:
+                # Still being written to, look again later
+                self._writing = writing
+                self._timer = self._loop.call_later(self.delay, self._fire)
+                return
+            self._writing = None
+        if self._task is not None:
+            self._again = True  # Picked up once the reload that is running is done
+            return
+        self._task = asyncio.create_task(self._reload())
+
+    async def _reload(self) -> None:
+        try:
+            while True:
+                self._again = False
+                try:
+                    loaded = await self._loop.run_in_executor(None, self._load)
+                    if loaded is not None:
+                        self._apply(*loaded)
+                except Exception:
+                    self._failed()
+                if not self._again:
+                    return
+        finally:
+            self._task = None
+
+    def _digest(self) -> bytes:
+        h = hashlib.blake2b(digest_size=16)
+        for path in sorted(self.paths):
+            h.update(path.encode() + b'\0')
+            try:
+                with open(path, 'rb') as f:
+                    while block := f.read(1 << 20):
+                        h.update(block)
+            except FileNotFoundError:
+                h.update(b'\1')
+            h.update(b'\0')
+        return h.digest()
+
+    def _load(self) -> Optional[tuple[bytes, Any, float]]:
+        start = time.perf_counter()
+        digest = self._digest()
+        if digest == self.digest:
+            self.skipped += 1
+            self.log.debug('Files did not change, not reloading')
+            return None
+        return digest, self.load(), start
+
+    def _apply(self, digest: bytes, loaded: Any, start: float) -> None:
+        self.apply(loaded)
+        self.digest = digest
+        self.generation += 1
+        self.reloads += 1
+        self.duration = time.perf_counter() - start
+        self.log.info(f'Reloaded generation {self.generation} in {self.duration:.3f}s')
+
+    def _failed(self) -> None:
+        # Keep what we had until the files can be loaded again
+        self.failed += 1
+        self.log.error(f'Could not reload, staying on generation {self.generation}')
+        self.log.error(traceback.format_exc())
+
+    def metrics(self) -> dict:
+        return {
+            'generation': self.generation,
+            'events': self.events,
+            'reloads': self.reloads,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'duration': self.duration,
+        }
@@ -0,0 +1,202 @@
+# This file is part of DTE-ERAU. Copyright 2023 Embry-Riddle Aeronautical University
+#
+# DTE-ERAU is free software: you can redistribute it and/or modify it under the terms of the GNU 
+# General Public License as published by the Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# DTE-ERAU is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. 
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with DTE-ERAU. If not, see 
+# <https://www.gnu.org/licenses/>. 
+
+
+import logging
+import os
+import queue
+from contextlib import contextmanager
+from lupa import LuaRuntime
+from typing import Any, Iterator
+
+# The parts of the standard library that policies and mapping functions may use. Nothing here can reach the
+# filesystem, the process, python or the other chunks.
+SAFE_GLOBALS = (
+    'assert', 'error', 'ipairs', 'next', 'pairs', 'pcall', 'select', 'tonumber', 'tostring', 'type', 'unpack',
+    'xpcall', 'math', 'string', 'table', 'utf8',
+)
+
+# Runs a chunk with a fresh environment on top of the inputs, counting instructions with a debug hook. The inputs
+# fall back to the safe globals, and the globals that a chunk sets end up in the fresh environment so one call never
+# sees what another one left behind. The pcall and xpcall that chunks see pass the instruction limit on instead of
+# catching it, as the hook would otherwise start counting again and a loop around a pcall would never end. The
+# libraries (math, string, ...) are shared by every call, so chunks only get read-only views of them.
+RUNNER = '''
+local base = ...
+local sethook, getinfo = debug.sethook, debug.getinfo
+local setmetatable, setfenv, pcall, xpcall, error, next = setmetatable, setfenv, pcall, xpcall, error, next
+local LIMIT = setmetatable({}, {__tostring = function() return 'instruction limit exceeded' end})
+local run
+local function stop()
+    -- Not between the end of the call and clearing the hook
+    if getinfo(2, 'f').func ~= run then
+        error(LIMIT, 0)
+    end
+end
+local function rethrow(ok, ...)
+    if not ok and ... == LIMIT then
+        error(LIMIT, 0)
+    end
+    return ok, ...
+end
+base.__index.pcall = function(f, ...)
+    return rethrow(pcall(f, ...))
+end
+base.__index.xpcall = function(f, handler, ...)
+    return rethrow(xpcall(f, function(e)
+        if e == LIMIT then
+            return e
+        end
+        return handler(e)
+    end, ...))
+end
+for name, library in pairs(base.__index) do
+    if type(library) == 'table' then
+        base.__index[name] = setmetatable({}, {
+            __index = library,
+            __newindex = function() error(name .. ' is read-only', 2) end,
+            __pairs = function() return next, library, nil end,
+            __metatable = false,
+        })
+    end
+end
+local scopes = setmetatable({}, {__mode = 'k'})
+run = function(f, inputs, limit)
+    local scope = scopes[inputs]
+    if scope == nil then
+        setmetatable(inputs, base)
+        scope = {__index = inputs}
+        scopes[inputs] = scope
+    end
+    local env = setmetatable({}, scope)
+    if setfenv then
+        setfenv(f, env)
+    end
+    if limit > 0 then
+        sethook(stop, '', limit)
+    end
+    local ok, result = pcall(f, env)
+    sethook()
+    if not ok then
+        if result == LIMIT then
+            error('instruction limit exceeded', 0)
+        end
+        error(result, 0)
+    end
+    return result
+end
+return run
+'''
+
+
+class Chunk:
+    """
+    A piece of lua compiled once on every runtime of a sandbox, as a function of its environment
+    """
+    def __init__(self, source: str, functions: list):
+        self.source = source
+        self.functions = functions
+
+
+class Runtime:
+    """
+    One lua runtime of the pool, only ever used by one caller at a time
+    """
+    def __init__(self, index: int, instructions: int, memory: int):
+        self.index = index
+        self.instructions = instructions
+        self.memory = memory
+        self.calls = 0
+        self.errors = 0
+        self.lua = LuaRuntime(max_memory=0, register_eval=False, register_builtins=False)
+        lua_globals = self.lua.globals()
+        base = self.lua.table_from({name: lua_globals[name] for name in SAFE_GLOBALS if lua_globals[name] is not None})
+        self._run = self.lua.execute(RUNNER, self.lua.table_from({'__index': base}))
+
+    def compile(self, source: str):
+        # Lua 5.2+ looks globals up in the _ENV argument, older versions get it through setfenv
+        return self.lua.execute(f'return function(_ENV)\n{source}\nend')
+
+    def inputs(self, values: dict[str, Any]):
+        """
+        The inputs of a call as a table, which can be reused for more calls on this runtime
+        """
+        return self.lua.table_from(values)
+
+    def run(self, chunk: Chunk, inputs) -> Any:
+        self.calls += 1
+        if self.memory:
+            self.lua.set_max_memory(self.lua.get_memory_used() + self.memory)
+        try:
+            return self._run(chunk.functions[self.index], inputs, self.instructions)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            if self.memory:
+                self.lua.set_max_memory(0)
+
+
+class Sandbox:
+    """
+    A pool of lua runtimes that run chunks in their own environment, instead of sharing (and wiping) the globals of
+    a single runtime. Every call is limited in the instructions it may run and the memory it may allocate, so a
+    runaway chunk fails instead of stalling the service. Configured from the environment with the given prefix:
+
+        <PREFIX>_LUA_RUNTIMES      runtimes in the pool, the number of chunks that can run at once (default: size)
+        <PREFIX>_LUA_INSTRUCTIONS  instructions a single call may run, 0 for no limit (default 1000000)
+        <PREFIX>_LUA_MEMORY        bytes a single call may allocate, 0 for no limit (default 16MB)
+    """
+    def __init__(self, prefix: str, size: int = 1):
+        self.log = logging.getLogger(f'Sandbox {prefix}')
+        size = int(os.environ.get(f'{prefix}_LUA_RUNTIMES', size))
+        instructions = int(os.environ.get(f'{prefix}_LUA_INSTRUCTIONS', 1_000_000))
+        memory = int(os.environ.get(f'{prefix}_LUA_MEMORY', 16 * 1024 * 1024))
+        self.runtimes = [Runtime(i, instructions, memory) for i in range(max(size, 1))]
+        self._free = queue.SimpleQueue()  # type: queue.SimpleQueue[Runtime]
+        for runtime in self.runtimes:
+            self._free.put(runtime)
+
+    def compile(self, source: str) -> Chunk:
+        """
+        Raises a LuaError when the source does not compile
+        """
+        return Chunk(source, [runtime.compile(source) for runtime in self.runtimes])
+
+    @contextmanager
+    def runtime(self) -> Iterator[Runtime]:
+        """
+        Borrow a runtime, waiting for one to free up if they are all in use
+        """
+        runtime = self._free.get()
+        try:
+            yield runtime
+        finally:
+            self._free.put(runtime)
+
+    def run(self, chunk: Chunk, values: dict[str, Any]) -> Any:
+        """
+        Run a chunk once with the given inputs as its globals
+        """
+        runtime = self._free.get()
+        try:
+            return runtime.run(chunk, runtime.inputs(values))
+        finally:
+            self._free.put(runtime)
+
+    def metrics(self) -> dict:
+        return {
+            'runtimes': len(self.runtimes),
+            'calls': sum(runtime.calls for runtime in self.runtimes),
+            'errors': sum(runtime.errors for runtime in self.runtimes),
+        }
@@ -0,0 +1,383 @@
+# This file is part of DTE-ERAU. Copyright 2023 Embry-Riddle Aeronautical University
+#
+# DTE-ERAU is free software: you can redistribute it and/or modify it under the terms of the GNU 
+# General Public License as published by the Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# DTE-ERAU is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. 
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with DTE-ERAU. If not, see 
+# <https://www.gnu.org/licenses/>. 
+
+import aiohttp
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+from aiohttp import web
+from feed import ChangeFeed
+from typing import Optional, Sequence
+from wire import MSGPACK, dumps, loads, read, read_response, respond
+
+# Timeouts for talking to the shards, updates of large tables can take a while to apply
+SHARD_READ_TIMEOUT = aiohttp.ClientTimeout(total=5)
+SHARD_UPDATE_TIMEOUT = aiohttp.ClientTimeout(total=300)
+HEALTH_INTERVAL = 2  # Seconds between health checks of the shards
+
+
+class HashRing:
+    """
+    Consistent hashing of users onto shards, every shard owns many small ranges of the ring so that the users are
+    spread evenly. The same shard count always gives the same placement.
+    """
+    def __init__(self, shards: int, vnodes: int = 128):
+        points = sorted((self._hash(f'{shard}#{i}'), shard) for shard in range(shards) for i in range(vnodes))
+        self._points = [point for point, _shard in points]
+        self._shards = [shard for _point, shard in points]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'little')
+
+    def shard(self, user: str) -> int:
+        i = bisect.bisect(self._points, self._hash(user))
+        return self._shards[i % len(self._shards)]
+
+
+class Shard:
+    """
+    A DTE worker process that owns the users of one part of the hash ring, restarted when it exits
+    """
+    def __init__(self, index: int, port: int, env: dict[str, str]):
+        self.log = logging.getLogger(f'Shard {index}')
+        self.index = index
+        self.port = port
+        self.url = f'http://127.0.0.1:{port}'
+        self.env = env
+        self.process = None  # type: asyncio.subprocess.Process | None
+        self.healthy = False
+        self.restarts = 0
+        self.checked = None  # type: float | None
+        self.latency = None  # type: float | None
+        self.error = None  # type: str | None
+
+    async def run(self) -> None:
+        main = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+        while True:
+            self.process = await asyncio.create_subprocess_exec(sys.executable, main, env=self.env)
+            self.log.info(f'Started worker {self.process.pid} on port {self.port}')
+            code = await self.process.wait()
+            self.healthy = False
+            self.restarts += 1
+            self.log.error(f'Worker exited with {code}, restarting')
+            await asyncio.sleep(1)
+
+    def stop(self) -> None:
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+
+    def status(self) -> dict:
+        return {
+            'shard': self.index,
+            'url': self.url,
+            'pid': self.process.pid if self.process else None,
+            'healthy': self.healthy,
+            'restarts': self.restarts,
+            'checked': self.checked,
+            'latency': self.latency,
+            'error': self.error,
+        }
+
+
+class ShardError(Exception):
+    pass
+
+
+class Router:
+    """
+    Runs DTE as `count` worker processes that each own a share of the users, and splits the work between them.
+    Updates are split by user, reads are sent to the shards that hold the users and put back together in order.
+    """
+    def __init__(self, count: int, port: int, data: Optional[str] = None):
+        self.log = logging.getLogger('Router')
+        self.ring = HashRing(count)
+        self.shards = []  # type: list[Shard]
+        for i in range(count):
+            env = dict(os.environ, DTE_SHARDS='1', DTE_SHARD=str(i), PORT=str(port + i))
+            if data:
+                env['DTE_DATA'] = os.path.join(data, f'shard-{i}')
+            self.shards.append(Shard(i, port + i, env))
+        self.feed = ChangeFeed()
+        self.feed.on_active = self._feed_active
+        self.session = None  # type: aiohttp.ClientSession | None
+        self._tasks = []  # type: list[asyncio.Task]
+        self._relays = []  # type: list[asyncio.Task]
+
+    async def start(self, _app) -> None:
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0, limit_per_host=100))
+        self._tasks = [asyncio.create_task(shard.run()) for shard in self.shards]
+        self._tasks.append(asyncio.create_task(self._check_health()))
+
+    async def stop(self, _app) -> None:
+        for task in self._tasks + self._relays:
+            task.cancel()
+        for shard in self.shards:
+            shard.stop()
+        await asyncio.gather(*(s.process.wait() for s in self.shards if s.process), return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+
+    async def _check_health(self) -> None:
+        while True:
+            await asyncio.gather(*(self._check(shard) for shard in self.shards))
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    async def _check(self, shard: Shard) -> None:
+        start = time.time()
+        try:
+            async with self.session.get(f'{shard.url}/health', timeout=SHARD_READ_TIMEOUT) as response:
+                response.raise_for_status()
+            shard.healthy, shard.error = True, None
+            shard.latency = time.time() - start
+        except Exception as e:
+            if shard.healthy:
+                self.log.warning(f'Shard {shard.index} is unhealthy: {e!r}')
+            shard.healthy, shard.error = False, repr(e)
+        shard.checked = time.time()
+
+    async def _call(self, shard: Shard, method: str, path: str, body: bytes,
+                    timeout: aiohttp.ClientTimeout = SHARD_READ_TIMEOUT):
+        # The router and the shards always talk MessagePack to each other
+        headers = {'Content-Type': MSGPACK, 'Accept': MSGPACK}
+        try:
+            async with self.session.request(method, shard.url + path, data=body, timeout=timeout,
+                                            headers=headers) as response:
+                response.raise_for_status()
+                return await read_response(response)
+        except Exception as e:
+            raise ShardError(f'Shard {shard.index} failed {path}: {e!r}') from e
+
+    def split_update(self, body: bytes, content_type: str) -> list[bytes]:
+        """
+        Every shard gets the same update with only its own users in it, including shards without any users so that
+        their version and heartbeat stay in step with the rest
+        """
+        data = loads(body, content_type)
+        parts = [{k: v for k, v in data.items() if k not in ('scores', 'delta', 'removed')} for _ in self.shards]
+        shard = self.ring.shard
+        for field in ('scores', 'delta', 'removed'):
+            if field not in data:
+                continue
+            split = [{} for _ in self.shards]
+            for user, value in (data[field] or {}).items():
+                split[shard(user)][user] = value
+            for part, users in zip(parts, split):
+                part[field] = users
+        return [dumps(part, MSGPACK) for part in parts]
+
+    async def update(self, body: bytes, content_type: str) -> dict:
+        # Decoding and splitting a large push takes a while, so keep it off the loop that is proxying the reads
+        parts = await asyncio.get_running_loop().run_in_executor(None, self.split_update, body, content_type)
+        results = await asyncio.gather(*(
+            self._call(shard, 'POST', '/update', part, SHARD_UPDATE_TIMEOUT)
+            for shard, part in zip(self.shards, parts)
+        ), return_exceptions=True)
+        failed = [r for r in results if isinstance(r, Exception)]
+        for e in failed:
+            self.log.error(str(e))
+        versions = {r.get('version') for r in results if isinstance(r, dict)}
+        # Unless every shard is at the same version the TScP has to start over from a full push
+        if failed or len(versions) != 1 or any(isinstance(r, dict) and r.get('resync') for r in results):
+            return {'version': None, 'resync': True}
+        return {'version': versions.pop()}
+
+    async def broadcast(self, method: str, path: str, data=None) -> list:
+        body = dumps(data, MSGPACK) if data is not None else b''
+        return await asyncio.gather(*(self._call(shard, method, path, body) for shard in self.shards))
+
+    async def get(self, query: dict) -> dict:
+        return await self._call(self.shards[self.ring.shard(query['user'])], 'GET', '/get', dumps(query, MSGPACK))
+
+    async def bulk(self, queries: Sequence[tuple[str, list[str]]], detail: bool) -> list[dict]:
+        """
+        Send every shard the queries for its users at once, and put the results back in the order of the queries
+        """
+        by_shard = {}  # type: dict[int, list[int]]
+        for i, (user, _keys) in enumerate(queries):
+            by_shard.setdefault(self.ring.shard(user), []).append(i)
+
+        async def query(shard: int, indexes: list[int]) -> list[dict]:
+            body = dumps({'queries': [{'user': queries[i][0], 'keys': queries[i][1]} for i in indexes],
+                          'detail': detail}, MSGPACK)
+            return (await self._call(self.shards[shard], 'POST', '/bulk', body))['results']
+
+        out = [None] * len(queries)  # type: list[dict | None]
+        results = await asyncio.gather(*(query(shard, indexes) for shard, indexes in by_shard.items()))
+        for indexes, got in zip(by_shard.values(), results):
+            for i, scores in zip(indexes, got):
+                out[i] = scores
+        return out
+
+    async def status(self) -> dict:
+        """
+        The status of every TScP summed over the shards
+        """
+        merged = {}  # type: dict[str, dict]
+        for shard_status in await self.broadcast('GET', '/status'):
+            for name, tscp in shard_status.items():
+                into = merged.get(name)
+                if into is None:
+                    merged[name] = dict(tscp, expiry=dict(tscp['expiry']), version={tscp['version']})
+                    continue
+                into['users'] += tscp['users']
+                into['memory'] += tscp['memory']
+                into['version'].add(tscp['version'])
+                for state, count in tscp['expiry'].items():
+                    into['expiry'][state] = into['expiry'].get(state, 0) + count
+        for tscp in merged.values():
+            versions = tscp['version']
+            tscp['version'] = versions.pop() if len(versions) == 1 else sorted(versions, key=str)
+        return merged
+
+    def _feed_active(self, active: bool) -> None:
+        # Only follow the change feeds of the shards while someone is listening, so they do not publish for nothing
+        if active and not self._relays:
+            self._relays = [asyncio.create_task(self._relay(shard)) for shard in self.shards]
+        elif not active:
+            for task in self._relays:
+                task.cancel()
+            self._relays = []
+
+    async def _relay(self, shard: Shard) -> None:
+        connected = False
+        while True:
+            try:
+                async with self.session.ws_connect(f'{shard.url}/subscribe') as ws:
+                    if connected:
+                        self._lost()  # Anything that happened while we were reconnecting is gone
+                    connected = True
+                    async for msg in ws:
+                        if msg.type != aiohttp.WSMsgType.TEXT:
+                            continue
+                        events = json.loads(msg.data)
+                        if isinstance(events, dict):
+                            if events.get('resync'):
+                                self._lost()
+                            continue
+                        for event in events:
+                            self.feed.publish(event['user'], event['key'], event['old'], event['new'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.log.warning(f'Lost the change feed of shard {shard.index}: {e!r}')
+            await asyncio.sleep(1)
+
+    def _lost(self) -> None:
+        for sub in self.feed.subscribers:
+            sub.lost = True
+
+
+routes = web.RouteTableDef()
+
+
+def router_app(router: Router, feed_routes: web.RouteTableDef, max_body: int) -> web.Application:
+    app = web.Application(client_max_size=max_body)
+    app.add_routes(routes)
+    app.add_routes(feed_routes)
+    app['router'] = router
+    app['feed'] = router.feed
+    app.on_startup.append(router.start)
+    app.on_cleanup.append(router.stop)
+    return app
+
+
+@routes.get('/get')
+async def get_trust_scores(request):
+    router = request.app['router']  # type: Router
+    try:
+        query = await read(request)
+    except:
+        raise web.HTTPBadRequest()
+    if not isinstance(query, dict) or 'user' not in query:
+        raise web.HTTPBadRequest()
+    try:
+        return respond(request, await router.get(query))
+    except ShardError as e:
+        raise web.HTTPServiceUnavailable(text=str(e))
+
+
+@routes.post('/bulk')
+async def bulk_get_trust_scores(request):
+    router = request.app['router']  # type: Router
+    try:
+        body = await read(request)
+        if 'queries' in body:
+            queries = [(q['user'], q['keys']) for q in body['queries']]
+        else:
+            keys = body['keys']
+            queries = [(user, keys) for user in body['users']]
+        detail = bool(body.get('detail', False))
+    except:
+        raise web.HTTPBadRequest()
+    try:
+        results = await router.bulk(queries, detail)
+    except ShardError as e:
+        raise web.HTTPServiceUnavailable(text=str(e))
+
+    if 'application/x-ndjson' not in request.headers.get('Accept', ''):
+        return respond(request, {'results': results})
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    chunk = 1000
+    for i in range(0, len(queries), chunk):
+        lines = ''.join(
+            json.dumps({'user': user, 'scores': scores}) + '\n'
+            for (user, _keys), scores in zip(queries[i:i + chunk], results[i:i + chunk])
+        )
+        await response.write(lines.encode())
+    await response.write_eof()
+    return response
+
+
+@routes.get('/status')
+async def status(request):
+    try:
+        return respond(request, await request.app['router'].status())
+    except ShardError as e:
+        raise web.HTTPServiceUnavailable(text=str(e))
+
+
+@routes.get('/shards')
+async def shards(request):
+    router = request.app['router']  # type: Router
+    return web.json_response([shard.status() for shard in router.shards])
+
+
+@routes.get('/health')
+async def health(request):
+    router = request.app['router']  # type: Router
+    healthy = sum(shard.healthy for shard in router.shards)
+    body = {'healthy': healthy, 'shards': len(router.shards)}
+    return web.json_response(body, status=200 if healthy == len(router.shards) else 503)
+
+
+@routes.get('/onramp')
+@routes.post('/onramp')
+async def onramp(request):
+    try:
+        await request.app['router'].broadcast('POST', '/onramp', await read(request))
+    except ShardError as e:
+        raise web.HTTPServiceUnavailable(text=str(e))
+    return web.json_response(True)
+
+
+@routes.post('/update')
+async def update_trust_scores(request):
+    body = await request.read()
+    return respond(request, await request.app['router'].update(body, request.content_type))
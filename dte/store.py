@@ -0,0 +1,200 @@
+# This file is part of DTE-ERAU. Copyright 2023 Embry-Riddle Aeronautical University
+#
+# DTE-ERAU is free software: you can redistribute it and/or modify it under the terms of the GNU 
+# General Public License as published by the Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# DTE-ERAU is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. 
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with DTE-ERAU. If not, see 
+# <https://www.gnu.org/licenses/>. 
+
+import numpy as np
+from typing import Iterable, Optional
+
+
+def to_ms(ts: float) -> int:
+    return int(ts * 1000)
+
+
+class Interner:
+    """
+    Hands out a small integer for every name, reusing the numbers of names that were released
+    """
+    def __init__(self):
+        self.index = {}  # type: dict[str, int]
+        self.names = []  # type: list[Optional[str]]
+        self._free = []  # type: list[int]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index
+
+    def get(self, name: str) -> Optional[int]:
+        return self.index.get(name)
+
+    def intern(self, name: str) -> int:
+        i = self.index.get(name)
+        if i is None:
+            if self._free:
+                i = self._free.pop()
+                self.names[i] = name
+            else:
+                i = len(self.names)
+                self.names.append(name)
+            self.index[name] = i
+        return i
+
+    def release(self, i: int) -> None:
+        name = self.names[i]
+        if name is not None:
+            del self.index[name]
+            self.names[i] = None
+            self._free.append(i)
+
+
+class ScoreTable:
+    """
+    The scores of one TScP as a users x keys matrix of values, with the time every value was last updated in
+    milliseconds since the epoch (0 meaning there is no score). The rows come from an Interner that can be shared
+    between tables, so that the same user has the same row everywhere.
+    """
+    def __init__(self, users: Interner, dtype=np.float64, capacity: int = 1024):
+        self.users = users
+        self.keys = Interner()
+        self.values = np.zeros((capacity, 4), dtype=dtype)
+        self.updated = np.zeros((capacity, 4), dtype=np.int64)
+
+    def _reserve(self, rows: int, cols: int) -> None:
+        have_rows, have_cols = self.values.shape
+        if rows <= have_rows and cols <= have_cols:
+            return
+        while have_rows < rows:
+            have_rows *= 2
+        while have_cols < cols:
+            have_cols *= 2
+        values = np.zeros((have_rows, have_cols), dtype=self.values.dtype)
+        updated = np.zeros((have_rows, have_cols), dtype=np.int64)
+        r, c = self.values.shape
+        values[:r, :c] = self.values
+        updated[:r, :c] = self.updated
+        self.values, self.updated = values, updated
+
+    @property
+    def rows(self) -> int:
+        """
+        Rows in use, everything past this is empty
+        """
+        return min(len(self.users), self.values.shape[0])
+
+    def column(self, key: str, create: bool = False) -> Optional[int]:
+        if create:
+            col = self.keys.intern(key)
+            self._reserve(len(self.users), col + 1)
+            return col
+        return self.keys.get(key)
+
+    def row(self, user: str, create: bool = False) -> Optional[int]:
+        if create:
+            row = self.users.intern(user)
+            self._reserve(row + 1, len(self.keys))
+            return row
+        row = self.users.get(user)
+        if row is None or row >= self.values.shape[0]:
+            return None
+        return row
+
+    def rows_for(self, users: Iterable[str]) -> np.ndarray:
+        rows = np.fromiter(map(self.users.intern, users), dtype=np.intp)
+        self._reserve(len(self.users), len(self.keys))
+        return rows
+
+    def get(self, row: int, col: int) -> tuple[Optional[float], int]:
+        if row >= self.values.shape[0] or col >= self.values.shape[1]:
+            return None, 0
+        ts = int(self.updated[row, col])
+        if not ts:
+            return None, 0
+        return float(self.values[row, col]), ts
+
+    def has_row(self, row: int) -> bool:
+        return row < self.updated.shape[0] and bool(self.updated[row].any())
+
+    def has_rows(self, rows: np.ndarray) -> np.ndarray:
+        out = np.zeros(len(rows), dtype=bool)
+        inside = rows < self.updated.shape[0]
+        out[inside] = self.updated[rows[inside]].any(axis=1)
+        return out
+
+    def row_dict(self, row: int) -> dict[str, float]:
+        if row >= self.updated.shape[0]:
+            return {}
+        cols = np.flatnonzero(self.updated[row, :len(self.keys)])
+        names = self.keys.names
+        return dict(zip([names[c] for c in cols.tolist()], self.values[row, cols].tolist()))
+
+    def set_many(self, users: Iterable[tuple[str, dict[str, float]]], ts: int) -> np.ndarray:
+        """
+        Write the scores of many users at once, returns the rows that were written to
+        """
+        rows, cols, values = [], [], []
+        touched = []
+        for user, user_scores in users:
+            row = self.users.intern(user)
+            touched.append(row)
+            for k, v in user_scores.items():
+                rows.append(row)
+                cols.append(self.keys.intern(k))
+                values.append(v)
+        self._reserve(len(self.users), len(self.keys))
+        if rows:
+            self.values[rows, cols] = values
+            self.updated[rows, cols] = ts
+        return np.array(touched, dtype=np.intp)
+
+    def write(self, rows: np.ndarray, col: int, values: np.ndarray, ts: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Write one column for the given rows, returns the previous values and their update times
+        """
+        old = self.values[rows, col]
+        old_ts = self.updated[rows, col]
+        self.values[rows, col] = values
+        self.updated[rows, col] = ts
+        return old, old_ts
+
+    def clear(self, rows, cols=slice(None)) -> None:
+        self.updated[rows, cols] = 0
+        self.values[rows, cols] = 0
+
+    def present(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The (rows, cols) of every score in the table
+        """
+        return np.nonzero(self.updated[:self.rows, :len(self.keys)])
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.updated))
+
+    def count_rows(self) -> int:
+        return int(np.count_nonzero(self.updated[:self.rows].any(axis=1)))
+
+    def nbytes(self) -> int:
+        return self.values.nbytes + self.updated.nbytes
+
+
+class RowView:
+    """
+    Lets the lua mapping functions read `_score[user][key]` straight from a table
+    """
+    def __init__(self, table: ScoreTable):
+        self.table = table
+
+    def __getitem__(self, user: str) -> Optional[dict[str, float]]:
+        row = self.table.row(user)
+        if row is None or not self.table.has_row(row):
+            return None
+        return self.table.row_dict(row)
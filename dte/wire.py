@@ -0,0 +1,75 @@
+# This file is part of DTE-ERAU. Copyright 2023 Embry-Riddle Aeronautical University
+#
+# DTE-ERAU is free software: you can redistribute it and/or modify it under the terms of the GNU 
+# General Public License as published by the Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# DTE-ERAU is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. 
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with DTE-ERAU. If not, see 
+# <https://www.gnu.org/licenses/>. 
+
+import json
+import msgpack
+import os
+from aiohttp import web
+
+# Content negotiation between JSON and MessagePack. JSON stays the default, a client that sends
+# `Content-Type: application/msgpack` or asks for it with `Accept` gets MessagePack instead.
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+# What the clients in this service send, JSON unless WIRE_FORMAT=msgpack
+WIRE_FORMAT = MSGPACK if os.environ.get('WIRE_FORMAT', 'json').lower() == 'msgpack' else JSON
+
+
+def is_msgpack(content_type: str) -> bool:
+    return content_type in (MSGPACK, 'application/x-msgpack')
+
+
+def dumps(data, content_type: str = JSON) -> bytes:
+    if is_msgpack(content_type):
+        return msgpack.packb(data, use_bin_type=True)
+    return json.dumps(data).encode()
+
+
+def loads(body: bytes, content_type: str = JSON):
+    if is_msgpack(content_type):
+        return msgpack.unpackb(body, raw=False)
+    return json.loads(body)
+
+
+async def read(request: web.Request):
+    """
+    The decoded body of a request, in whichever format it was sent
+    """
+    return loads(await request.read(), request.content_type)
+
+
+def accepts_msgpack(request: web.Request) -> bool:
+    accept = request.headers.get('Accept', '')
+    return MSGPACK in accept or 'application/x-msgpack' in accept
+
+
+def respond(request: web.Request, data, status: int = 200) -> web.Response:
+    """
+    A response in MessagePack when the client asked for it, otherwise JSON
+    """
+    content_type = MSGPACK if accepts_msgpack(request) else JSON
+    return web.Response(body=dumps(data, content_type), status=status, content_type=content_type)
+
+
+def request_args(data, content_type: str = WIRE_FORMAT) -> dict:
+    """
+    Keyword arguments for an aiohttp client request that sends `data` and asks for the same format back
+    """
+    return {'data': dumps(data, content_type), 'headers': {'Content-Type': content_type, 'Accept': content_type}}
+
+
+async def read_response(response):
+    """
+    The decoded body of a client response, in whichever format the server answered with
+    """
+    return loads(await response.read(), response.content_type)
@@ -0,0 +1,124 @@
+# This file is part of DTE-ERAU. Copyright 2023 Embry-Riddle Aeronautical University
+#
+# DTE-ERAU is free software: you can redistribute it and/or modify it under the terms of the GNU 
+# General Public License as published by the Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# DTE-ERAU is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. 
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with DTE-ERAU. If not, see 
+# <https://www.gnu.org/licenses/>. 
+
+import heapq
+import re
+from typing import Optional
+
+# A pattern that is nothing but plain (or escaped) characters
+_LITERAL = re.compile(r'(?:[^\\.^$*+?{}\[\]|()]|\\[^A-Za-z0-9])*')
+_UNESCAPE = re.compile(r'\\(.)')
+
+
+def literal(pattern: str) -> Optional[tuple[str, str]]:
+    """
+    Splits the patterns that do not need a regex into (text, how it is anchored): 'prefix' for plain text, since
+    re.match only anchors at the start, 'end' for text followed by `$` (which also allows a trailing newline), and
+    'exact' for text followed by `\\Z`. Returns None for anything else.
+    """
+    for suffix, anchor in (('\\Z', 'exact'), ('$', 'end'), ('', 'prefix')):
+        if suffix and not pattern.endswith(suffix):
+            continue
+        body = pattern[:len(pattern) - len(suffix)]
+        if (len(body) - len(body.rstrip('\\'))) % 2:
+            continue  # The suffix was escaped
+        if _LITERAL.fullmatch(body):
+            return _UNESCAPE.sub(r'\1', body), anchor
+    return None
+
+
+def leading(pattern: str) -> str:
+    """
+    The plain text that every match of a pattern has to start with
+    """
+    if '|' in pattern:
+        return ''
+    text = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+            c, step = pattern[i + 1], 2
+        elif c in '\\.^$*+?{}[]|()':
+            break
+        else:
+            step = 1
+        if i + step < len(pattern) and pattern[i + step] in '*?{':
+            break  # This character is optional
+        text.append(c)
+        i += step
+    return ''.join(text)
+
+
+class _Bucket:
+    """
+    The policies of one resource group that apply to one combination of groups, in their original order
+    """
+    def __init__(self, policies: list[tuple[int, object]]):
+        self.exact = {}  # type: dict[str, tuple[int, object, bool]]  # text -> (order, policy, allows a trailing newline)
+        # length -> leading text -> [(order, policy, whether the regex still has to be run)]
+        self.prefixes = {}  # type: dict[int, dict[str, list[tuple[int, object, bool]]]]
+        for order, policy in policies:
+            split = literal(policy.resource.pattern)
+            if split is None:
+                text, regex = leading(policy.resource.pattern), True
+            elif split[1] == 'prefix':
+                text, regex = split[0], False
+            else:
+                self.exact.setdefault(split[0], (order, policy, split[1] == 'end'))
+                continue
+            self.prefixes.setdefault(len(text), {}).setdefault(text, []).append((order, policy, regex))
+
+    def match(self, resource: str):
+        best, found = None, None
+        hit = self.exact.get(resource)
+        if hit is not None:
+            best, found = hit[0], hit[1]
+        if resource.endswith('\n'):
+            hit = self.exact.get(resource[:-1])
+            if hit is not None and hit[2] and (best is None or hit[0] < best):
+                best, found = hit[0], hit[1]
+        # Only the policies whose leading text the resource starts with can match, tried in their original order
+        candidates = [
+            texts[resource[:length]]
+            for length, texts in self.prefixes.items()
+            if length <= len(resource) and resource[:length] in texts
+        ]
+        for order, policy, regex in heapq.merge(*candidates):
+            if best is not None and order > best:
+                break
+            if not regex or policy.resource.match(resource) is not None:
+                return policy
+        return found
+
+
+class PolicyIndex:
+    """
+    Finds the first policy (in file order) for a resource group and resource that applies to any of a user's
+    groups, without going through all of the policies. The policies are split by resource group, and for every
+    combination of groups that users are in we keep only the policies that apply to it, with the literal resources
+    in hash maps and the regex patterns in order.
+    """
+    def __init__(self, policies: list):
+        self.by_resource_group = {}  # type: dict[str, list[tuple[int, object]]]
+        for order, policy in enumerate(policies):
+            self.by_resource_group.setdefault(policy.resource_group, []).append((order, policy))
+        self._buckets = {}  # type: dict[tuple[frozenset, str], _Bucket]
+
+    def find(self, groups: frozenset, resource_group: str, resource: str):
+        bucket = self._buckets.get((groups, resource_group))
+        if bucket is None:
+            candidates = self.by_resource_group.get(resource_group, ())
+            bucket = _Bucket([(order, policy) for order, policy in candidates if policy.groups & groups])
+            self._buckets[(groups, resource_group)] = bucket
+        return bucket.match(resource)
@@ -12,38 +12,60 @@
 # <https://www.gnu.org/licenses/>. 
 
 import aiohttp
+import asyncio
 import json
 import logging
 import os
 import re
-import traceback
+import time
+import uuid
 import yaml
 from aiohttp import web
+from cache import DecisionCache
+from collections import deque
 from dataclasses import dataclass
-from datetime import datetime, timedelta
-from lupa import LuaRuntime
-from typing import Callable
-from watchdog.events import FileSystemEventHandler
-from watchdog.observers import Observer
+from datetime import timedelta
+from index import PolicyIndex
+from pool import ClientPool
+from predicate import PredicateCompiler
+from reload import Reloader
+from replica import ScoreReplica
+from sandbox import Chunk, Sandbox
+from typing import Callable, Optional
+from wire import read, read_response, request_args, respond
+from workers import Saturated, WorkerPool
 
 logging.basicConfig(level=logging.INFO)
 root = logging.getLogger()
 logging.getLogger('aiohttp.access').setLevel(logging.ERROR)
 root.debug("Starting...")
 
-EXPIRE_TIME = timedelta(seconds=10)
+# How long decisions are cached for, denials are kept shorter so that users get in soon after their scores recover
+ALLOW_TTL = timedelta(seconds=float(os.environ.get('PDP_CACHE_ALLOW_TTL', 10)))
+DENY_TTL = timedelta(seconds=float(os.environ.get('PDP_CACHE_DENY_TTL', 2)))
+CACHE_SIZE = int(os.environ.get('PDP_CACHE_SIZE', 100000))
+# Lua policies run on worker threads (0 runs them on the event loop). When every worker is busy up to EVAL_QUEUE
+# evaluations wait for one, past that or after EVAL_DEADLINE the request is denied.
+EVAL_WORKERS = int(os.environ.get('PDP_EVAL_WORKERS', os.cpu_count() or 1))
+EVAL_QUEUE = int(os.environ.get('PDP_EVAL_QUEUE', 1000))
+EVAL_DEADLINE = timedelta(seconds=float(os.environ.get('PDP_EVAL_DEADLINE', 0.5)))
+# Keep a replica of the trust scores that the policies need in process, instead of asking DTE for every decision.
+# Scores are not taken from the replica once it has been out of touch with DTE for longer than REPLICA_MAX_LAG.
+REPLICA = os.environ.get('PDP_REPLICA', '0') not in ('0', 'false', '')
+REPLICA_MAX_LAG = timedelta(seconds=float(os.environ.get('PDP_REPLICA_MAX_LAG', 5)))
+# Neither is a score that DTE no longer has live, or that was last refreshed longer than REPLICA_MAX_AGE ago
+REPLICA_MAX_AGE = timedelta(seconds=float(os.environ.get('PDP_REPLICA_MAX_AGE', 300)))
+# Every response tells the generation of the decisions, which changes when the policies change, so that callers that
+# keep decisions know when to drop them. Changes to the trust scores only drop the decisions of the users concerned,
+# which callers ask /generation for: the last SCORE_CHANGES are kept, a caller further behind drops everything.
+GENERATION_HEADER = 'X-PDP-Generation'
+SCORE_CHANGES = int(os.environ.get('PDP_SCORE_CHANGES', 1000))
+# The count of reloads starts over in every process, so the generation carries which process it is from
+BOOT_ID = uuid.uuid4().hex[:12]
 
 routes = web.RouteTableDef()
 
 
-class WatchdogHandler(FileSystemEventHandler):
-    def __init__(self, callback):
-        self.callback = callback
-      
-    def on_modified(self, event):
-        time.sleep(0.1)
-        self.callback(event.src_path)
-
 @dataclass
 class Policy:
     name: str
@@ -51,64 +73,103 @@ class Policy:
     resource: str
     groups: set[str]
     keys: list[str]
-    function: Callable[[], None]
+    function: Chunk
     code: str
+    # The same policy as plain python, when it is simple enough to not need lua
+    predicate: Optional[Callable[[dict], bool]] = None
+
+    @property
+    def backend(self) -> str:
+        return 'python' if self.predicate is not None else 'lua'
 
 class PolicyEngine:
-    DTE_URL_GET = 'http://dte:9991/get'
+    DTE_URL = 'http://dte:9991'
+    DTE_URL_GET = f'{DTE_URL}/get'
 
     def __init__(self, location: str):
         self.log = logging.getLogger('PolicyEngine')
         self.log.debug('Starting...')
         self.location = location
-        self._lua = LuaRuntime()
-        self._globs = self._lua.globals()
+        self.sandbox = Sandbox('PDP', size=max(EVAL_WORKERS, 1))  # A runtime for every worker
+        self.workers = WorkerPool(EVAL_WORKERS, EVAL_QUEUE, EVAL_DEADLINE) if EVAL_WORKERS > 0 else None
         self.policies = []
+        self.index = PolicyIndex([])
         self.group_to_users = {}
         self.user_to_groups = {}
-        self.reload()
-        self._cached = {}
-        self.start_watchdog()
-
-    def start_watchdog(self):
-        self._watchdog = Observer()
-        watch_dir = os.path.dirname(self.location)
-        def look_for_file(fn: str):
-            if fn == self.location:
-                self.reload()
-        self._watchdog.schedule(WatchdogHandler(look_for_file), path=watch_dir)
-        self._watchdog.start()
-
-    def reload(self):
-        self.log.debug('Reloading...')
-        try:
-            # Load the yaml definition stored as a file
-            with open(self.location) as f:
-                data = yaml.safe_load(f)
+        self.cache = DecisionCache(CACHE_SIZE, ALLOW_TTL, DENY_TTL, group=lambda key: key[0])  # By user
+        self.dte = ClientPool('DTE')  # Kept open for as long as the app runs
+        self.replica = ScoreReplica(self.DTE_URL, self.dte, REPLICA_MAX_LAG, REPLICA_MAX_AGE) if REPLICA else None
+        if self.replica is not None:
+            # Decisions are cheap with the scores at hand, so a user's are only cached until their scores change
+            self.replica.on_change = self.scores_changed
+        self.changes = 0  # Count of the score changes so far
+        self._changes = deque(maxlen=SCORE_CHANGES)  # type: deque[tuple[int, set[str]]]  # The last ones, by count
+        # The policy file is parsed and compiled off the event loop whenever it changes
+        self.reloader = Reloader('PDP', [location], self.load, self.publish)
+        self.reloader.reload_now()
+        # Concurrent requests for the same decision, or for the same scores of a user, share one evaluation / fetch
+        self._evaluating = {}  # type: dict[tuple[str, str, str], asyncio.Task]
+        self._fetching = {}  # type: dict[tuple[str, tuple[str, ...]], asyncio.Task]
+        self.coalesced = {'eval': 0, 'dte': 0}
 
-            # Load groups and users going in either direction
-            group_to_users = data['groups']
-            user_to_groups = {}
-            for group, users in group_to_users.items():
-                for user in users:
-                    user_to_groups.setdefault(user, set()).add(group)
+    def scores_changed(self, users: set[str]) -> None:
+        self.cache.drop(users)
+        self.changes += 1
+        self._changes.append((self.changes, users))
 
-            # Load the policies
-            policies = list(map(self.create_policy, data['policies']))
+    def changed_since(self, since: int) -> Optional[set[str]]:
+        """
+        The users whose scores changed after the given count of changes, None when that is no longer known
+        """
+        if since > self.changes:
+            return None  # A count from another process
+        if since < self.changes and (not self._changes or since < self._changes[0][0] - 1):
+            return None
+        users = set()
+        for count, changed in reversed(self._changes):
+            if count <= since:
+                break
+            users |= changed
+        return users
 
-        except Exception as e:
-            # Something failed, so we will not be applying the change
-            self.log.error('Could not reload the policy engine')
-            self.log.error(traceback.format_exc())
-        else:
-            # Success, apply the changes
-            self.policies = policies
-            self.group_to_users = group_to_users
-            self.user_to_groups = user_to_groups
-            self.log.info('Reloaded policy!')
-            self.log.debug(f'Groups: {group_to_users}')
-            self.log.debug(f'Users: {user_to_groups}')
-            self.log.debug(f'Policies: {policies}')
+    def load(self) -> tuple[list[Policy], PolicyIndex, dict, dict]:
+        """
+        Parse and compile the policy file, runs on a worker thread
+        """
+        # Load the yaml definition stored as a file
+        with open(self.location) as f:
+            data = yaml.safe_load(f)
+
+        # Load groups and users going in either direction
+        group_to_users = data['groups']
+        user_to_groups = {}
+        for group, users in group_to_users.items():
+            for user in users:
+                user_to_groups.setdefault(user, set()).add(group)
+        # Users in the same groups share the same entries in the policy index
+        user_to_groups = {user: frozenset(groups) for user, groups in user_to_groups.items()}
+
+        # Load the policies
+        policies = list(map(self.create_policy, data['policies']))
+        return policies, PolicyIndex(policies), group_to_users, user_to_groups
+
+    def publish(self, loaded: tuple[list[Policy], PolicyIndex, dict, dict]) -> None:
+        """
+        Switch to what `load` came up with, on the event loop so that no request sees half of it
+        """
+        policies, index, group_to_users, user_to_groups = loaded
+        self.policies = policies
+        self.index = index
+        self.group_to_users = group_to_users
+        self.user_to_groups = user_to_groups
+        # Decisions made under the old policies no longer hold
+        self.cache.invalidate()
+        if self.replica is not None:
+            self.replica.set_scope(user_to_groups, {key for policy in policies for key in policy.keys})
+        self.log.info('Reloaded policy!')
+        self.log.debug(f'Groups: {group_to_users}')
+        self.log.debug(f'Users: {user_to_groups}')
+        self.log.debug(f'Policies: {policies}')
 
     def create_policy(self, policy) -> Policy:
         rg = policy['resource_group']
@@ -122,75 +183,182 @@ class PolicyEngine:
             resource=re.compile(r),
             groups=set(policy['groups']),
             keys=policy['keys'],
-            function=self._lua.compile(function),
-            code=function
+            function=self.sandbox.compile(function),
+            code=function,
+            predicate=PredicateCompiler.compile(function),
         )
 
     async def eval_cached(self, user: str, resource_group: str, resource: str) -> bool:
         key = (user, resource_group, resource)
-        got = self._cached.get(key, None)
-        now = datetime.now()
+        got = self.cache.get(key)
         if got is not None:
-            cache, time = got
-            dt = now - time
-            if dt < EXPIRE_TIME:
-                return cache
+            return got
+        pending = self._evaluating.get(key)
+        if pending is None:
+            pending = self._evaluating[key] = asyncio.create_task(self._eval_and_cache(key))
+            pending.add_done_callback(lambda _task: self._evaluating.pop(key, None))
+        else:
+            self.coalesced['eval'] += 1
+        return await asyncio.shield(pending)
+
+    async def _eval_and_cache(self, key: tuple[str, str, str]) -> bool:
+        since = self.cache.clock
         got = await self.eval(*key)
-        self._cached[key] = (got, now)
+        self.cache.put(key, got, since)
         return got
 
-    async def eval(self, user: str, resource_group: str, resource: str) -> bool:
+    async def fetch_scores(self, user: str, keys: list[str]) -> dict:
+        """
+        The trust scores of a user from the replica if it can answer, or else DTE. Policies that need the same keys
+        share the request.
+        """
+        if self.replica is not None:
+            got = self.replica.lookup(user, keys)
+            if got is not None:
+                return got
+        key = (user, tuple(keys))
+        pending = self._fetching.get(key)
+        if pending is None:
+            pending = self._fetching[key] = asyncio.create_task(self._fetch_scores(user, keys))
+            pending.add_done_callback(lambda _task: self._fetching.pop(key, None))
+        else:
+            self.coalesced['dte'] += 1
+        return await asyncio.shield(pending)
+
+    async def _fetch_scores(self, user: str, keys: list[str]) -> dict:
+        if self.replica is None:
+            async with self.dte.get(self.DTE_URL_GET, **request_args({
+                'user': user,
+                'keys': keys
+            })) as response:
+                response.raise_for_status()
+                return await read_response(response)
+        # What the replica could not answer is handed back to it, so the next lookup can
+        asked = time.time()
+        async with self.dte.get(self.DTE_URL_GET, **request_args({
+            'user': user,
+            'keys': keys,
+            'detail': True,
+        })) as response:
+            response.raise_for_status()
+            detail = await read_response(response)
+        self.replica.refresh(user, detail, asked)
+        return {k: d['value'] for k, d in detail.items()}
+
+    async def eval_batch(self, checks: list[tuple[str, str, str]]) -> list[bool]:
+        """
+        Decide many (user, resource group, resource) at once. Cached decisions are used as they are, and the trust
+        scores that the rest need are fetched with one request to DTE per user.
+        """
+        since = self.cache.clock
+        decisions = {}  # type: dict[tuple[str, str, str], bool]
+        pending = {}  # type: dict[tuple[str, str, str], asyncio.Task]
+        by_user = {}  # type: dict[str, dict[tuple[str, str, str], Policy]]
+        for key in dict.fromkeys(checks):
+            got = self.cache.get(key)
+            if got is not None:
+                decisions[key] = got
+            elif key in self._evaluating:
+                self.coalesced['eval'] += 1
+                pending[key] = self._evaluating[key]
+            else:
+                policy = self.find_policy(*key)
+                if policy is None:
+                    decisions[key] = False
+                    self.cache.put(key, False, since)
+                else:
+                    by_user.setdefault(key[0], {})[key] = policy
+        await asyncio.gather(*(self._eval_user(user, policies, since, decisions) for user, policies in by_user.items()))
+        for key, task in pending.items():
+            decisions[key] = await asyncio.shield(task)
+        return [decisions[key] for key in checks]
+
+    async def _eval_user(self, user: str, policies: dict[tuple[str, str, str], Policy], since: int, decisions: dict) -> None:
+        keys = sorted(set().union(*(policy.keys for policy in policies.values())))
+        scores = {}
+        if keys:
+            self.log.debug(f'Fetching {", ".join(keys)} from DTE')
+            try:
+                scores = await self.fetch_scores(user, keys)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                for key in policies:
+                    self.log.warning(f'--DENY-- {user} accessing {key[1]}:{key[2]}, could not get the trust scores from DTE: {e!r}')
+                    decisions[key] = False
+                    self.cache.put(key, False, since)
+                return
+
+        async def apply(key: tuple[str, str, str], policy: Policy) -> None:
+            # Every policy sees the scores it asked for and nothing more, just like a single evaluation
+            dte_vars = {k: scores[k] for k in policy.keys if k in scores}
+            decisions[key] = result = await self.apply(policy, *key, dte_vars)
+            self.cache.put(key, result, since)
+        await asyncio.gather(*(apply(key, policy) for key, policy in policies.items()))
+
+    def find_policy(self, user: str, resource_group: str, resource: str) -> Optional[Policy]:
         groups = self.user_to_groups.get(user)
         if groups is None:
             self.log.warning(f'The user {user} is not recognized by any group')
-            return False  # Does not belong to any group that has permissions / not a registered user
-        for policy in self.policies:
-            if resource_group != policy.resource_group:
-                continue  # Does not apply to this resource group
-            if policy.resource.match(resource) is None:
-                continue  # Does not apply to this resource
-            if not (policy.groups & groups):
-                continue  # Does not apply to the groups this user is in
-
-            # This actually applies to us:
-            self.log.debug(f'Apply policy: {policy.name}')
-            # Lets see what we need from DTE
-            if policy.keys:
-                self.log.debug(f'Fetching {", ".join(policy.keys)} from DTE')
-                async with aiohttp.ClientSession() as session:
-                    response = await session.get(self.DTE_URL_GET, json={
-                        'user': user,
-                        'keys': policy.keys
-                    })
-                    dte_vars = await response.json()
-            else:
-                # This policy does not use trust score values
-                dte_vars = {}
-            # Wipe our runtime globals
-            for k in self._globs.keys():
-                del self._globs[k]
-            self._globs['dte'] = dte_vars
-            # Run the function
+            return None  # Does not belong to any group that has permissions / not a registered user
+        # The first policy for this resource group and resource that applies to any of the user's groups
+        policy = self.index.find(groups, resource_group, resource)
+        if policy is None:
+            self.log.warning(f'--DENY-- {user} accessing {resource_group}:{resource} got default denied due to fall-through case')
+        return policy
+
+    async def eval(self, user: str, resource_group: str, resource: str) -> bool:
+        policy = self.find_policy(user, resource_group, resource)
+        if policy is None:
+            return False # Default deny run-through case
+        self.log.debug(f'Apply policy: {policy.name}')
+        # Lets see what we need from DTE
+        if policy.keys:
+            self.log.debug(f'Fetching {", ".join(policy.keys)} from DTE')
             try:
-                result = bool(policy.function())
-            except Exception as e:
-                self.log.warning(f'Error trying to apply policy ({policy.name}): {e}')
-                result = False
-            else:
-                if not result:
-                    self.log.warning(f'Policy {policy.name}:\n{policy.code}\nVARS = {json.dumps(dte_vars, indent=4)}')
-            status_text = 'allowed' if result else 'denied'
-            self.log.debug(f'{status_text}: {user} accessing {resource_group}:{resource} by the policy {policy.name}')
-            return result
+                dte_vars = await self.fetch_scores(user, policy.keys)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.log.warning(f'--DENY-- {user} accessing {resource_group}:{resource}, could not get the trust scores from DTE: {e!r}')
+                return False
+        else:
+            # This policy does not use trust score values
+            dte_vars = {}
+        return await self.apply(policy, user, resource_group, resource, dte_vars)
 
-        self.log.warning(f'--DENY-- {user} accessing {resource_group}:{resource} got default denied due to fall-through case')
-        return False # Default deny run-through case
+    async def apply(self, policy: Policy, user: str, resource_group: str, resource: str, dte_vars: dict) -> bool:
+        # Run the function
+        try:
+            result = bool(await self.run(policy, dte_vars))
+        except Saturated as e:
+            self.log.warning(f'--DENY-- {user} accessing {resource_group}:{resource}, too busy to apply policy ({policy.name}): {e}')
+            result = False
+        except asyncio.TimeoutError:
+            self.log.warning(f'--DENY-- {user} accessing {resource_group}:{resource}, policy ({policy.name}) did not finish within {EVAL_DEADLINE.total_seconds()}s')
+            result = False
+        except Exception as e:
+            self.log.warning(f'Error trying to apply policy ({policy.name}): {e}')
+            result = False
+        else:
+            if not result:
+                self.log.warning(f'Policy {policy.name}:\n{policy.code}\nVARS = {json.dumps(dte_vars, indent=4)}')
+        status_text = 'allowed' if result else 'denied'
+        self.log.debug(f'{status_text}: {user} accessing {resource_group}:{resource} by the policy {policy.name}')
+        return result
+
+    async def run(self, policy: Policy, dte_vars: dict):
+        # Native predicates are cheaper to run than to hand to a worker
+        if policy.predicate is not None:
+            return policy.predicate(dte_vars)
+        if self.workers is None:
+            return self.sandbox.run(policy.function, {'dte': dte_vars})
+        return await self.workers.run(self.sandbox.run, policy.function, {'dte': dte_vars})
 
 pe = PolicyEngine('./policy.yaml')
 
+def current_generation() -> str:
+    return f'{BOOT_ID}:{pe.cache.generation}'
+
 @routes.post('/auth')
 async def hello(request):
-    body = await request.json()
+    body = await read(request)
     user = body['user']
     rg = body['resource_group']
     r = body['resource']
@@ -198,11 +366,88 @@ async def hello(request):
     status_text = 'allowed' if result else '--DENIED--'
     root.info(f'{status_text}: {user} accessing {rg}:{r}')
     status = 200 if result else 403
-    return web.Response(text="", status=status)
+    return web.Response(text="", status=status, headers={GENERATION_HEADER: current_generation()})
+
+@routes.post('/auth/batch')
+async def auth_batch(request):
+    """
+    Many checks in one request: {"checks": [{"user", "resource_group", "resource"}, ...]}, where "user" can also be
+    given once for all of them. Answers {"decisions": [...]} in the order of the checks.
+    """
+    body = await read(request)
+    try:
+        checks = [
+            (check.get('user', body.get('user')), check['resource_group'], check['resource'])
+            for check in body['checks']
+        ]
+    except (KeyError, TypeError, AttributeError):
+        raise web.HTTPBadRequest(text='Expected {"checks": [{"user", "resource_group", "resource"}, ...]}')
+    if any(not isinstance(user, str) for user, _rg, _r in checks):
+        raise web.HTTPBadRequest(text='Every check needs a user')
+    decisions = await pe.eval_batch(checks)
+    for (user, rg, r), result in zip(checks, decisions):
+        status_text = 'allowed' if result else '--DENIED--'
+        root.info(f'{status_text}: {user} accessing {rg}:{r}')
+    response = respond(request, {'decisions': decisions})
+    response.headers[GENERATION_HEADER] = current_generation()
+    return response
+
+@routes.get('/generation')
+async def generation(request):
+    """
+    The generation of the decisions and the count of score changes. Given `since`, an earlier count, also the users
+    whose decisions changed after it, or null for all of them.
+    """
+    body = {'generation': current_generation(), 'changes': pe.changes}
+    if 'since' in request.query:
+        try:
+            since = int(request.query['since'])
+        except ValueError:
+            raise web.HTTPBadRequest(text='Expected a count of changes for since')
+        users = pe.changed_since(since)
+        body['users'] = sorted(users) if users is not None else None
+    return respond(request, body)
+
+@routes.get('/debug')
+async def debug(request):
+    return web.json_response({
+        'policies': [
+            {
+                'name': policy.name,
+                'resource_group': policy.resource_group,
+                'resource': policy.resource.pattern,
+                'groups': sorted(policy.groups),
+                'keys': policy.keys,
+                'backend': policy.backend,
+            }
+            for policy in pe.policies
+        ],
+    })
+
+@routes.get('/metrics')
+async def metrics(request):
+    return web.json_response({
+        'dte': pe.dte.metrics(),
+        'cache': pe.cache.metrics(),
+        'coalesced': pe.coalesced,
+        'lua': pe.sandbox.metrics(),
+        'workers': pe.workers.metrics() if pe.workers is not None else None,
+        'replica': pe.replica.metrics() if pe.replica is not None else None,
+        'reload': pe.reloader.metrics(),
+    })
 
 def main():
     app = web.Application()
     app.add_routes(routes)
+    app.on_startup.append(pe.dte.start)
+    app.on_cleanup.append(pe.dte.stop)
+    app.on_startup.append(pe.reloader.start)
+    app.on_cleanup.append(pe.reloader.stop)
+    if pe.workers is not None:
+        app.on_cleanup.append(pe.workers.stop)
+    if pe.replica is not None:
+        app.on_startup.append(pe.replica.start)
+        app.on_cleanup.append(pe.replica.stop)
     web.run_app(app, port=9990)
 
 if __name__ == '__main__':
@@ -0,0 +1,129 @@
+# This file is part of DTE-ERAU. Copyright 2023 Embry-Riddle Aeronautical University
+#
+# DTE-ERAU is free software: you can redistribute it and/or modify it under the terms of the GNU 
+# General Public License as published by the Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# DTE-ERAU is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. 
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with DTE-ERAU. If not, see 
+# <https://www.gnu.org/licenses/>. 
+
+import aiohttp
+import logging
+import os
+import time
+from types import SimpleNamespace
+
+
+class ClientPool:
+    """
+    One aiohttp session with keep-alive connections for the lifetime of the app, instead of a new session (and new
+    connections) for every request. Configured from the environment with the given prefix:
+
+        <PREFIX>_POOL_LIMIT       connections in total (default 100)
+        <PREFIX>_POOL_PER_HOST    connections per host (default: the total)
+        <PREFIX>_KEEPALIVE        seconds an idle connection is kept open (default 30)
+        <PREFIX>_TIMEOUT          seconds for a whole request (default 2)
+        <PREFIX>_CONNECT_TIMEOUT  seconds to wait for a connection, including waiting for a free one (default 1)
+    """
+    def __init__(self, prefix: str):
+        self.log = logging.getLogger(f'ClientPool {prefix}')
+        self.limit = int(os.environ.get(f'{prefix}_POOL_LIMIT', 100))
+        self.limit_per_host = int(os.environ.get(f'{prefix}_POOL_PER_HOST', self.limit))
+        self.keepalive = float(os.environ.get(f'{prefix}_KEEPALIVE', 30))
+        self.timeout = aiohttp.ClientTimeout(
+            total=float(os.environ.get(f'{prefix}_TIMEOUT', 2)),
+            connect=float(os.environ.get(f'{prefix}_CONNECT_TIMEOUT', 1)),
+        )
+        self.session = None  # type: aiohttp.ClientSession | None
+        # Metrics
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.created = 0  # New connections
+        self.reused = 0  # Requests that got a connection that was already open
+        self.queued = 0  # Requests that had to wait for a connection to free up
+        self.waiting = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def start(self, _app=None) -> None:
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self._request_start)
+        trace.on_request_end.append(self._request_end)
+        trace.on_request_exception.append(self._request_exception)
+        trace.on_connection_queued_start.append(self._queued_start)
+        trace.on_connection_queued_end.append(self._queued_end)
+        trace.on_connection_create_end.append(self._created)
+        trace.on_connection_reuseconn.append(self._reused)
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive,
+        )
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout, trace_configs=[trace])
+        self.log.info(f'Pooling up to {self.limit} connections ({self.limit_per_host} per host)')
+
+    async def stop(self, _app=None) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+    def request(self, method: str, url: str, **kwargs):
+        """
+        Same as aiohttp's session.request, with the pool's timeouts unless given others
+        """
+        if self.session is None:
+            raise RuntimeError('The client pool is not started')
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    async def _request_start(self, _session, _context, _params) -> None:
+        self.requests += 1
+        self.in_flight += 1
+
+    async def _request_end(self, _session, _context, _params) -> None:
+        self.in_flight -= 1
+
+    async def _request_exception(self, _session, _context, _params) -> None:
+        self.in_flight -= 1
+        self.errors += 1
+
+    async def _queued_start(self, _session, context: SimpleNamespace, _params) -> None:
+        self.queued += 1
+        self.waiting += 1
+        context.queued_at = time.perf_counter()
+
+    async def _queued_end(self, _session, context: SimpleNamespace, _params) -> None:
+        self.waiting -= 1
+        waited = time.perf_counter() - context.queued_at
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    async def _created(self, _session, _context, _params) -> None:
+        self.created += 1
+
+    async def _reused(self, _session, _context, _params) -> None:
+        self.reused += 1
+
+    def metrics(self) -> dict:
+        return {
+            'limit': self.limit,
+            'limit_per_host': self.limit_per_host,
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'errors': self.errors,
+            'connections_created': self.created,
+            'connections_reused': self.reused,
+            'queued': self.queued,
+            'waiting': self.waiting,
+            'wait_avg_ms': self.wait_total / self.queued * 1000 if self.queued else 0.0,
+            'wait_max_ms': self.wait_max * 1000,
+        }
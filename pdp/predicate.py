@@ -0,0 +1,209 @@
+# This file is part of DTE-ERAU. Copyright 2023 Embry-Riddle Aeronautical University
+#
+# DTE-ERAU is free software: you can redistribute it and/or modify it under the terms of the GNU 
+# General Public License as published by the Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# DTE-ERAU is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. 
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with DTE-ERAU. If not, see 
+# <https://www.gnu.org/licenses/>. 
+
+import re
+from typing import Callable, Optional
+
+_TOKEN = re.compile(r'''\s*(?:
+    (?P<number>\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?)
+  | (?P<string>'[^'\\\n]*'|"[^"\\\n]*")
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<op>==|~=|<=|>=|<|>|=|\[|\]|\(|\)|-|;)
+)''', re.VERBOSE)
+KEYWORDS = {
+    'and', 'break', 'do', 'else', 'elseif', 'end', 'false', 'for', 'function', 'goto', 'if', 'in',
+    'local', 'nil', 'not', 'or', 'repeat', 'return', 'then', 'true', 'until', 'while',
+}
+ORDERING = {'<', '<=', '>', '>='}
+
+# Node types: every statement and the result are booleans, the operands of comparisons are values
+BOOL = 'bool'
+VALUE = 'value'
+NUMBER = 'number'
+NIL = 'nil'
+
+
+def _num(value):
+    # Lua only orders numbers with numbers, anything else (including a missing score) is an error
+    if type(value) is float or type(value) is int:
+        return value
+    raise TypeError(f'attempt to compare number with {"nil" if value is None else type(value).__name__}')
+
+
+def _eq(a, b) -> bool:
+    # Unlike python, lua never considers true and 1 equal
+    if isinstance(a, bool) or isinstance(b, bool):
+        return a is b
+    return a == b
+
+
+class Unsupported(Exception):
+    pass
+
+
+class PredicateCompiler:
+    """
+    Compiles the policies that are only comparisons of `dte[...]` with constants, combined with and/or/not and
+    assigned to variables, such as
+
+        user_authentication = dte['google:user:user_authentication'] > 0.5
+        iap = dte['google:network:physical_network:private_network:iap'] > 0.5
+        return user_authentication and iap
+
+    into a python function of the dte scores that behaves the same as the lua (including raising where lua would).
+    Anything else is left to lua.
+    """
+    def __init__(self, source: str):
+        self.tokens = self._tokenize(source)
+        self.pos = 0
+        self.assigned = set()  # type: set[str]
+
+    @classmethod
+    def compile(cls, source: str) -> Optional[Callable[[dict], bool]]:
+        try:
+            code = cls(source)._chunk()
+        except Unsupported:
+            return None
+        namespace = {'_num': _num, '_eq': _eq}
+        exec(compile(code, '<policy>', 'exec'), namespace)
+        return namespace['predicate']
+
+    @staticmethod
+    def _tokenize(source: str) -> list[tuple[str, str]]:
+        tokens = []
+        pos = 0
+        source = source.rstrip()
+        while pos < len(source):
+            m = _TOKEN.match(source, pos)
+            if m is None or m.end() == pos:
+                raise Unsupported(f'Unexpected character at {pos}')
+            kind = m.lastgroup
+            value = m.group(kind)
+            if kind == 'name' and value in KEYWORDS:
+                kind = 'keyword'
+            tokens.append((kind, value))
+            pos = m.end()
+        return tokens
+
+    def _peek(self) -> tuple[str, str]:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else ('end', '')
+
+    def _next(self) -> tuple[str, str]:
+        token = self._peek()
+        self.pos += 1
+        return token
+
+    def _expect(self, kind: str, value: str) -> None:
+        if self._next() != (kind, value):
+            raise Unsupported(f'Expected {value}')
+
+    def _chunk(self) -> str:
+        lines = ['def predicate(dte):']
+        while self._peek() != ('keyword', 'return'):
+            kind, name = self._next()
+            if kind != 'name' or name == 'dte':
+                raise Unsupported(f'Unsupported statement at {name!r}')
+            self._expect('op', '=')
+            code = self._boolean()
+            lines.append(f'    v_{name} = {code}')
+            self.assigned.add(name)
+            if self._peek() == ('op', ';'):
+                self.pos += 1
+        self.pos += 1
+        lines.append(f'    return {self._boolean()}')
+        if self._peek() == ('op', ';'):
+            self.pos += 1
+        if self.pos != len(self.tokens):
+            raise Unsupported('Trailing statements')
+        return '\n'.join(lines) + '\n'
+
+    def _boolean(self) -> str:
+        kind, code = self._or()
+        if kind != BOOL:
+            raise Unsupported('Only boolean expressions are compiled')
+        return code
+
+    # The grammar follows the lua operator precedence: or < and < comparison < not
+    def _or(self) -> tuple[str, str]:
+        kind, code = self._and()
+        while self._peek() == ('keyword', 'or'):
+            self.pos += 1
+            right_kind, right = self._and()
+            if kind != BOOL or right_kind != BOOL:
+                raise Unsupported('or of non-booleans')
+            code = f'({code} or {right})'
+        return kind, code
+
+    def _and(self) -> tuple[str, str]:
+        kind, code = self._comparison()
+        while self._peek() == ('keyword', 'and'):
+            self.pos += 1
+            right_kind, right = self._comparison()
+            if kind != BOOL or right_kind != BOOL:
+                raise Unsupported('and of non-booleans')
+            code = f'({code} and {right})'
+        return kind, code
+
+    def _comparison(self) -> tuple[str, str]:
+        kind, code = self._unary()
+        op = self._peek()
+        if op[0] != 'op' or op[1] not in ORDERING | {'==', '~='}:
+            return kind, code
+        self.pos += 1
+        right_kind, right = self._unary()
+        op = op[1]
+        if op in ('==', '~='):
+            if BOOL in (kind, right_kind):
+                raise Unsupported('Comparing booleans')
+            test = f'_eq({code}, {right})'
+            return BOOL, test if op == '==' else f'(not {test})'
+        # Ordering needs a number on one side, so that the other side has to be a number as well
+        if NIL in (kind, right_kind) or BOOL in (kind, right_kind) or NUMBER not in (kind, right_kind):
+            raise Unsupported('Unsupported ordering')
+        return BOOL, f'(_num({code}) {op} _num({right}))'
+
+    def _unary(self) -> tuple[str, str]:
+        if self._peek() == ('keyword', 'not'):
+            self.pos += 1
+            kind, code = self._unary()
+            if kind != BOOL:
+                raise Unsupported('not of a non-boolean')
+            return BOOL, f'(not {code})'
+        return self._primary()
+
+    def _primary(self) -> tuple[str, str]:
+        kind, value = self._next()
+        if kind == 'number':
+            return NUMBER, repr(float(value))
+        if (kind, value) == ('op', '-') and self._peek()[0] == 'number':
+            return NUMBER, repr(-float(self._next()[1]))
+        if kind == 'keyword' and value in ('true', 'false'):
+            return BOOL, 'True' if value == 'true' else 'False'
+        if (kind, value) == ('keyword', 'nil'):
+            return NIL, 'None'
+        if (kind, value) == ('name', 'dte'):
+            self._expect('op', '[')
+            key_kind, key = self._next()
+            if key_kind != 'string':
+                raise Unsupported('Only constant keys are compiled')
+            self._expect('op', ']')
+            return VALUE, f'dte[{key[1:-1]!r}]'
+        if kind == 'name':
+            if value not in self.assigned:
+                raise Unsupported(f'{value} is not assigned before it is used')
+            return BOOL, f'v_{value}'
+        if (kind, value) == ('op', '('):
+            inner = self._or()
+            self._expect('op', ')')
+            return inner
+        raise Unsupported(f'Unexpected {value!r}')
@@ -0,0 +1,244 @@
+# This file is part of DTE-ERAU. Copyright 2023 Embry-Riddle Aeronautical University
+#
+# DTE-ERAU is free software: you can redistribute it and/or modify it under the terms of the GNU 
+# General Public License as published by the Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# DTE-ERAU is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. 
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with DTE-ERAU. If not, see 
+# <https://www.gnu.org/licenses/>. 
+
+
+import aiohttp
+import asyncio
+import json
+import logging
+import time
+from datetime import timedelta
+from pool import ClientPool
+from typing import Callable, Iterable, Optional
+from wire import read_response, request_args
+
+SNAPSHOT_TIMEOUT = aiohttp.ClientTimeout(total=60)
+RECONNECT_DELAY = 1  # Seconds between attempts to reach DTE
+LIVE = 'live'  # The state DTE gives a score that is current
+
+# (value, state in DTE, when it was last known to be fresh as a unix time). Scores that DTE does not have are kept as
+# (None, None, when we learned that).
+Entry = tuple[Optional[float], Optional[str], float]
+
+
+class ScoreReplica:
+    """
+    A copy of the trust scores that the policies need (the users in the groups times the keys of the policies),
+    loaded from DTE with one bulk request and kept current from its change feed, so that a lookup never leaves the
+    process.
+
+    A key is only served once it was loaded, and only while the feed that keeps it current is connected, or has been
+    for less than `max_lag`. Every key is also only served while DTE had it live and it was refreshed less than
+    `max_age` ago, since DTE's heartbeats and scores turning old do not show up in the feed. Anything else is a miss
+    and the caller goes to DTE instead, which can hand back what it got with `refresh`.
+    """
+    def __init__(self, url: str, pool: ClientPool, max_lag: timedelta, max_age: timedelta):
+        self.log = logging.getLogger('ScoreReplica')
+        self.url = url
+        self.pool = pool
+        self.max_lag = max_lag.total_seconds()
+        self.max_age = max_age.total_seconds()
+        self.scores = {}  # type: dict[str, dict[str, Entry]]
+        self.users = frozenset()  # type: frozenset[str]  # What is loaded
+        self.keys = frozenset()  # type: frozenset[str]
+        self._scope = (frozenset(), frozenset())  # What the policies need
+        self.connected = False
+        self.synced = float('-inf')  # When the replica was last known to be current (time.monotonic)
+        self._loop = None  # type: asyncio.AbstractEventLoop | None
+        self._ws = None  # type: aiohttp.ClientWebSocketResponse | None
+        self._task = None  # type: asyncio.Task | None
+        self.on_change = None  # type: Optional[Callable[[set[str]], None]]  # Called with the users whose scores changed
+        # Metrics
+        self.hits = 0
+        self.misses = 0  # Outside of what is loaded
+        self.stale = 0  # Not current enough to answer
+        self.expired = 0  # Keys that were not live, or not refreshed for too long
+        self.refreshed = 0
+        self.events = 0
+        self.snapshots = 0
+
+    def set_scope(self, users: Iterable[str], keys: Iterable[str]) -> None:
+        """
+        Change what the replica holds, safe to call from any thread. The new scope is loaded from a new connection to
+        the feed, until then the old one keeps being served.
+        """
+        scope = (frozenset(users), frozenset(keys))
+        if scope == self._scope:
+            return
+        self._scope = scope
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._reconnect)
+
+    def _reconnect(self) -> None:
+        if self._ws is not None:
+            asyncio.create_task(self._ws.close())
+
+    def lag(self) -> float:
+        if self.connected:
+            return 0.0
+        return time.monotonic() - self.synced
+
+    def lookup(self, user: str, keys: list[str]) -> Optional[dict]:
+        """
+        The scores in the same shape as DTE's /get, or None when the replica cannot answer
+        """
+        if user not in self.users or not self.keys.issuperset(keys):
+            self.misses += 1
+            return None
+        if not self.connected and time.monotonic() - self.synced > self.max_lag:
+            self.stale += 1
+            return None
+        scores = self.scores.get(user, {})
+        oldest = time.time() - self.max_age
+        got = {}
+        for k in keys:
+            entry = scores.get(k)
+            if entry is None:
+                continue  # Not a score that DTE knows of
+            value, state, fresh = entry
+            if (state is not None and state != LIVE) or fresh < oldest:
+                self.expired += 1
+                return None
+            got[k] = value
+        self.hits += 1
+        return got
+
+    def refresh(self, user: str, detail: dict[str, dict], asked: float) -> None:
+        """
+        Take in scores of a user that the caller got from DTE with `detail`, having asked at the unix time `asked`.
+        Nothing newer that came in from the feed meanwhile is overwritten.
+        """
+        scores = self.scores.get(user)
+        if scores is None or not self.connected:
+            return
+        for k, d in detail.items():
+            if k not in self.keys:
+                continue
+            entry = self._entry(d, asked)
+            current = scores.get(k)
+            if current is None or entry[2] >= current[2]:
+                scores[k] = entry
+        self.refreshed += 1
+
+    @staticmethod
+    def _entry(detail: dict, asked: float) -> Entry:
+        if detail['value'] is None:
+            return None, None, asked
+        return detail['value'], detail['state'], detail['updated']
+
+    @staticmethod
+    def _values(scores: dict[str, Entry]) -> dict[str, Optional[float]]:
+        return {k: entry[0] for k, entry in scores.items()}
+
+    async def start(self, _app=None) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, _app=None) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                async with self.pool.session.ws_connect(f'{self.url}/subscribe', heartbeat=self.max_lag / 2 or None) as ws:
+                    self._ws = ws
+                    await self._follow(ws)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                self.log.warning(f'Lost the change feed of DTE: {e!r}')
+            finally:
+                if self.connected:
+                    self.synced = time.monotonic()
+                self.connected = False
+                self._ws = None
+            if self._scope != (self.users, self.keys):
+                continue  # Closed to load a new scope
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _follow(self, ws: aiohttp.ClientWebSocketResponse) -> None:
+        users, keys = self._scope
+        # Subscribe before loading, so that no change in between is missed
+        await ws.send_json({'users': sorted(users), 'keys': sorted(keys)})
+        await self._load(users, keys)
+        self.connected = True
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                break
+            data = json.loads(msg.data)
+            if isinstance(data, list):
+                self._apply(data)
+            elif data.get('resync'):
+                # Changes were dropped, start over from a fresh copy
+                self.log.warning('Fell behind on the change feed, reloading')
+                self.connected = False
+                self.synced = time.monotonic()
+                await self._load(users, keys)
+                self.connected = True
+            elif 'error' in data:
+                self.log.error(f'DTE refused the subscription: {data["error"]}')
+
+    async def _load(self, users: frozenset[str], keys: frozenset[str]) -> None:
+        start = time.time()
+        if users and keys:
+            user_list = sorted(users)
+            async with self.pool.post(f'{self.url}/bulk', timeout=SNAPSHOT_TIMEOUT, **request_args({
+                'users': user_list,
+                'keys': sorted(keys),
+                'detail': True,
+            })) as response:
+                response.raise_for_status()
+                results = (await read_response(response))['results']
+            scores = {
+                user: {k: self._entry(d, start) for k, d in result.items()}
+                for user, result in zip(user_list, results)
+            }
+        else:
+            scores = {}
+        old, self.scores = self.scores, scores
+        self.users, self.keys = users, keys
+        self.snapshots += 1
+        if self.on_change is not None:
+            values = self._values
+            changed = {user for user, user_scores in scores.items() if values(old.get(user, {})) != values(user_scores)}
+            changed.update(user for user in old if user not in scores)
+            if changed:
+                self.on_change(changed)
+        self.log.info(f'Loaded {len(keys)} keys of {len(users)} users in {time.time() - start:.3f}s')
+
+    def _apply(self, events: list[dict]) -> None:
+        changed = set()
+        for event in events:
+            user_scores = self.scores.get(event['user'])
+            if user_scores is not None:
+                # A score that was just written is live, one that went stale is gone
+                new = event['new']
+                user_scores[event['key']] = (new, LIVE if new is not None else None, event['time'])
+                changed.add(event['user'])
+        self.events += len(events)
+        if changed and self.on_change is not None:
+            self.on_change(changed)
+
+    def metrics(self) -> dict:
+        return {
+            'connected': self.connected,
+            'lag': self.lag(),
+            'users': len(self.users),
+            'keys': len(self.keys),
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'expired': self.expired,
+            'refreshed': self.refreshed,
+            'events': self.events,
+            'snapshots': self.snapshots,
+        }
@@ -0,0 +1,77 @@
+# This file is part of DTE-ERAU. Copyright 2023 Embry-Riddle Aeronautical University
+#
+# DTE-ERAU is free software: you can redistribute it and/or modify it under the terms of the GNU 
+# General Public License as published by the Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# DTE-ERAU is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. 
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with DTE-ERAU. If not, see 
+# <https://www.gnu.org/licenses/>. 
+
+
+import asyncio
+import concurrent.futures
+from datetime import timedelta
+from typing import Any, Callable
+
+
+class Saturated(Exception):
+    """
+    Every worker is busy and the queue is full
+    """
+
+
+class WorkerPool:
+    """
+    Runs blocking work (lua) on a pool of threads so that it never holds up the event loop. At most `queue` calls wait
+    for a free worker, past that new calls are rejected straight away, and a caller stops waiting for a call after
+    `deadline` (the call itself runs to completion or to its instruction limit in the background).
+    """
+    def __init__(self, workers: int, queue: int, deadline: timedelta):
+        self.workers = workers
+        self.queue = queue
+        self.deadline = deadline.total_seconds()
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='eval')
+        self.pending = 0  # Running or waiting for a worker
+        # Metrics
+        self.calls = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        """
+        Raises Saturated when there is no room in the queue and asyncio.TimeoutError when the deadline passes
+        """
+        if self.pending >= self.workers + self.queue:
+            self.rejected += 1
+            raise Saturated(f'{self.pending} calls are already running or queued')
+        loop = asyncio.get_running_loop()
+        self.calls += 1
+        self.pending += 1
+        future = loop.run_in_executor(self._executor, fn, *args)
+        # Only count the call as done when the worker is, even if we stopped waiting for it
+        future.add_done_callback(self._done)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.deadline)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+
+    def _done(self, _future) -> None:
+        self.pending -= 1
+
+    async def stop(self, _app=None) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def metrics(self) -> dict:
+        return {
+            'workers': self.workers,
+            'queue': self.queue,
+            'pending': self.pending,
+            'calls': self.calls,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+        }
@@ -0,0 +1,163 @@
+# This file is part of DTE-ERAU. Copyright 2023 Embry-Riddle Aeronautical University
+#
+# DTE-ERAU is free software: you can redistribute it and/or modify it under the terms of the GNU 
+# General Public License as published by the Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# DTE-ERAU is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. 
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with DTE-ERAU. If not, see 
+# <https://www.gnu.org/licenses/>. 
+
+
+import csv
+import hashlib
+import json
+import mmap
+import os
+import yaml
+from typing import Iterator, Optional
+
+# The C (libyaml) loader is many times faster than the pure python one, when pyyaml was built with it
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+Scores = dict[str, dict[str, float]]
+
+
+def _digest(line: bytes) -> bytes:
+    return hashlib.blake2b(line, digest_size=16).digest()
+
+
+def _lines(location: str) -> Iterator[tuple[int, bytes]]:
+    """
+    The (line number, line) of a file, raises a ValueError when the last line is not finished with a newline
+    """
+    with open(location, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for number, line in enumerate(iter(mm.readline, b''), 1):
+                if line[-1:] != b'\n':
+                    raise ValueError(f'{location}:{number}: the line is cut off, it does not end in a newline')
+                yield number, line
+
+
+def load_mapping(location: str) -> Optional[dict[str, str]]:
+    with open(location, 'rb') as f:
+        return (yaml.load(f, Loader=YamlLoader) or {}).get('mapping')
+
+
+class ScoreFile:
+    """
+    Reads a file of trust scores, by its extension one of:
+
+        .yaml / .yml     {"mapping": {...}, "scores": {user: {key: score}}}
+        .ndjson / .jsonl one {"user": ..., "scores": {key: score}} per line, and optionally a {"mapping": {...}} line
+        .csv             a "user,<key>,<key>,..." header, then a line per user with an empty cell for a missing score
+
+    The line formats are read through mmap, and only the lines that changed since the last load get parsed: every
+    line is hashed and the lines seen before reuse what was parsed from them then, so users that did not change keep
+    the very same dict. A CSV file has no mapping, it can be given in the yaml format as `mapping_location`.
+
+    Every line has to end in a newline and every CSV row has to have a cell per column of the header, so that a file
+    that is cut off (still being written, or a failed export) raises a ValueError instead of loading part of the users.
+    """
+    FORMATS = {'.yaml': 'yaml', '.yml': 'yaml', '.ndjson': 'ndjson', '.jsonl': 'ndjson', '.csv': 'csv'}
+
+    def __init__(self, location: str, mapping_location: Optional[str] = None):
+        self.location = location
+        self.mapping_location = mapping_location
+        self.format = self.FORMATS.get(os.path.splitext(location)[1].lower(), 'yaml')
+        self._rows = {}  # type: dict[bytes, tuple]  # Line digest -> what was parsed from it
+        self._scores = {}  # type: Scores
+        # Of the last load
+        self.parsed = 0
+        self.reused = 0
+
+    def load(self) -> tuple[Scores, Optional[dict[str, str]]]:
+        """
+        The scores and mapping in the file, with the names as strings and the scores as floats
+        """
+        self.parsed = self.reused = 0
+        if self.format == 'ndjson':
+            scores, mapping = self._load_ndjson()
+        elif self.format == 'csv':
+            scores, mapping = self._load_csv(), None
+        else:
+            scores, mapping = self._load_yaml()
+        if self.mapping_location is not None:
+            mapping = load_mapping(self.mapping_location)
+        self._scores = scores
+        return scores, mapping
+
+    def _load_yaml(self) -> tuple[Scores, Optional[dict[str, str]]]:
+        with open(self.location, 'rb') as f:
+            data = yaml.load(f, Loader=YamlLoader)
+        scores = {}
+        for user, vals in data['scores'].items():
+            user = str(user)
+            vals = {str(k): float(v) for k, v in vals.items()}
+            prev = self._scores.get(user)
+            if prev == vals:
+                vals = prev
+                self.reused += 1
+            else:
+                self.parsed += 1
+            scores[user] = vals
+        return scores, data.get('mapping')
+
+    def _load_ndjson(self) -> tuple[Scores, Optional[dict[str, str]]]:
+        rows = {}
+        scores = {}
+        mapping = None
+        for _number, line in _lines(self.location):
+            if line.isspace():
+                continue
+            digest = _digest(line)
+            row = self._rows.get(digest)
+            if row is None:
+                data = json.loads(line)
+                if 'mapping' in data:
+                    row = ('mapping', data['mapping'])
+                else:
+                    row = (str(data['user']), {str(k): float(v) for k, v in data['scores'].items()})
+                self.parsed += 1
+            else:
+                self.reused += 1
+            rows[digest] = row
+            if row[0] == 'mapping':
+                mapping = row[1]
+            else:
+                scores[row[0]] = row[1]
+        self._rows = rows
+        return scores, mapping
+
+    def _load_csv(self) -> Scores:
+        lines = _lines(self.location)
+        _number, header = next(lines, (0, None))
+        if header is None:
+            return {}
+        keys = next(csv.reader([header.decode()]))[1:]
+        # Rows are only the same as before under the same header
+        header_digest = _digest(header)
+        rows = {}
+        scores = {}
+        for number, line in lines:
+            if line.isspace():
+                continue
+            digest = _digest(header_digest + line)
+            row = self._rows.get(digest)
+            if row is None:
+                cells = next(csv.reader([line.decode()]))
+                if len(cells) != len(keys) + 1:
+                    raise ValueError(f'{self.location}:{number}: {len(cells)} cells where the header has {len(keys) + 1}')
+                row = (cells[0], {k: float(v) for k, v in zip(keys, cells[1:]) if v != ''})
+                self.parsed += 1
+            else:
+                self.reused += 1
+            rows[digest] = row
+            scores[row[0]] = row[1]
+        self._rows = rows
+        return scores
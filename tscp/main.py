@@ -16,37 +16,66 @@ import asyncio
 import json
 import logging
 import os
-import time
-import yaml
 from aiohttp import web
+from ingest import ScoreFile
+from reload import Reloader
 from typing import Dict
-from watchdog.events import FileSystemEventHandler
-from watchdog.observers import Observer
+from wire import read, read_response, request_args, respond
 
 
 DTE_URL = 'http://dte:9991'
 DTE_URL_TS_UPDATE = f'{DTE_URL}/update'
 DTE_URL_ONRAMP = f'{DTE_URL}/onramp'
 
-class WatchdogHandler(FileSystemEventHandler):
-    def __init__(self, callback):
-        self.callback = callback
-      
-    def on_modified(self, event):
-        time.sleep(0.1)
-        self.callback(event.src_path)
+def diff_scores(old: Dict[str, Dict[str, float]], new: Dict[str, Dict[str, float]]):
+    """
+    Find the users and keys that changed between two score tables, and those that are gone from the new one
+    """
+    delta = {}
+    removed = {}
+    for user, vals in new.items():
+        prev = old.get(user)
+        if prev is None:
+            delta[user] = vals
+        elif prev is not vals and prev != vals:  # Users that did not change are the same dict after a reload
+            changed = {k: v for k, v in vals.items() if prev.get(k) != v}
+            if changed:
+                delta[user] = changed
+            gone = [k for k in prev if k not in vals]
+            if gone:
+                removed[user] = gone
+    for user, prev in old.items():
+        if user not in new:
+            removed[user] = list(prev)
+    return delta, removed
 
 class FileTScP:
-    mapping: Dict[str, str]
-
-    def __init__(self, name: str, location: str):
+    def __init__(self, name: str, location: str, mapping_location: str | None = None):
         self.log = logging.getLogger(f'TScP {name}')
         self.log.info(f'Starting TScP ({location})')
         self.name = name
         self.location = location
-        self.mapping = None
-        self.reload()
-        self.start_watchdog()
+        self.file = ScoreFile(location, mapping_location)
+        # The (version, scores, mapping) being served. A reload builds new ones and swaps them in at once, so a reader
+        # that takes the tuple never sees half of a reload.
+        self.published = (0, {}, None)  # type: tuple[int, Dict[str, Dict[str, float]], Dict[str, str] | None]
+        # The (version, scores, mapping) that DTE last acknowledged, deltas are sent against this
+        self._acked = None
+        # The files are read off the event loop whenever they change
+        self.reloader = Reloader('TSCP', [location, mapping_location], self.load, self.publish)
+        self.reloader.reload_now()
+
+    @property
+    def version(self) -> int:
+        return self.published[0]
+
+    @property
+    def scores(self) -> Dict[str, Dict[str, float]]:
+        return self.published[1]
+
+    @property
+    def mapping(self) -> Dict[str, str] | None:
+        return self.published[2]
 
     def start_task(self):
         self._loop_task = asyncio.create_task(self._trust_score_loop())
@@ -57,46 +86,84 @@ class FileTScP:
             await asyncio.sleep(60)
 
     async def send_trust_scores(self):
-        self.log.info("Sending recent trust scores")
-        out = {
-            'name': self.name,
-            'scores': self.scores,
-        }
-        if self.mapping:
-            out['mapping'] = self.mapping
+        """
+        Send what changed since the version DTE acknowledged. When DTE asks for a resync the full table is sent right
+        away, but only once: if that is not taken either (say a shard of DTE is down) we try again on the next tick.
+        """
+        version, scores, mapping = self.published
+        full = self._acked is None
+        if full:
+            self.log.info(f"Sending all trust scores (version {version})")
+            out = {
+                'name': self.name,
+                'version': version,
+                'scores': scores,
+            }
+            if mapping:
+                out['mapping'] = mapping
+        else:
+            # Only send what changed since the version DTE has, an empty delta is just a heartbeat
+            acked_version, acked_scores, acked_mapping = self._acked
+            delta, removed = diff_scores(acked_scores, scores)
+            self.log.info(f"Sending trust score changes {acked_version} -> {version} ({len(delta)} changed, {len(removed)} removed)")
+            out = {
+                'name': self.name,
+                'base': acked_version,
+                'version': version,
+                'delta': delta,
+                'removed': removed,
+            }
+            if mapping != acked_mapping:
+                out['mapping'] = mapping or {}
+
         async with aiohttp.ClientSession() as session:
-            _response = await session.post(DTE_URL_TS_UPDATE, json=out)
-
-    def start_watchdog(self):
-        self._watchdog = Observer()
-        watch_dir = os.path.dirname(self.location)
-        def look_for_file(fn: str):
-            if fn == self.location:
-                self.reload()
-            else:
-                self.log.debug(f'{fn} != {self.location}')
-        self._watchdog.schedule(WatchdogHandler(look_for_file), path=watch_dir)
-        self._watchdog.start()
-
-    def reload(self):
-        self.log.info('Reloading!')
-        with open(self.location) as f:
-            data = yaml.safe_load(f)
-        # We need to ensure that all the usernames and keys are strings and all the values are floats
-        self.mapping = data.get('mapping')
-        self.scores = {str(user): {str(k): float(v) for k, v in vals.items()} for user, vals in data['scores'].items()}
-        self.log.debug(f'{self.name} is loading with {self.scores}')
+            response = await session.post(DTE_URL_TS_UPDATE, **request_args(out))
+            try:
+                result = await read_response(response)
+            except Exception as e:
+                self.log.warning(f'Could not read the response from DTE: {e}')
+                return
+        if not isinstance(result, dict):
+            # Does not understand versions, we will keep on sending everything
+            self._acked = None
+        elif result.get('resync'):
+            self._acked = None
+            if full:
+                self.log.warning(f'DTE did not take the full table (at version {result.get("version")}), trying again later')
+                return
+            self.log.warning(f'DTE is at version {result.get("version")}, resending everything')
+            await self.send_trust_scores()  # Full this time, so it does not come back here
+        elif result.get('version') == version:
+            self._acked = (version, scores, mapping)
+
+    def load(self) -> tuple[int, Dict[str, Dict[str, float]], Dict[str, str] | None]:
+        """
+        Read the files into the next (version, scores, mapping), runs on a worker thread
+        """
+        version, old_scores, old_mapping = self.published
+        # All the usernames and keys come out as strings and all the values as floats
+        scores, mapping = self.file.load()
+        changed = self.file.parsed > 0 or len(scores) != len(old_scores) or mapping != old_mapping
+        if changed and scores == old_scores and mapping == old_mapping:
+            changed = False  # Rewritten the same
+        self.log.info(f'Loaded {len(scores)} users ({self.file.parsed} rows parsed, {self.file.reused} unchanged)')
+        return version + 1 if changed else version, scores, mapping
+
+    def publish(self, published: tuple[int, Dict[str, Dict[str, float]], Dict[str, str] | None]) -> None:
+        self.published = published
 
     async def send_onramp(self):
         async with aiohttp.ClientSession() as session:
             response = await session.post(DTE_URL_ONRAMP, json={
                 'name': self.name,
-                'pull': None  # Optional: This is url that the DTE can contact us to get up-to-date trust score information
+                'pull': os.environ.get('PULL_URL')  # Optional: This is url that the DTE can contact us to get up-to-date trust score information
             })
 
-    def get(self, user, scores) -> dict[str, float]:
-        score_table = self.scores[user]
-        return {k: score_table[k] for k in scores}
+    def get(self, user, scores=None) -> dict[str, float]:
+        score_table = self.scores.get(user, {})
+        if scores is None:
+            return dict(score_table)
+        return {k: score_table[k] for k in scores if k in score_table}
 
 def main():
     logging.basicConfig(level=logging.DEBUG)
@@ -104,22 +171,23 @@ def main():
     root.debug("Starting...")
 
     name = os.environ.get('NAME')
-    file = os.environ.get('FILE')
-    tscp = FileTScP(name, file)
+    file = os.environ.get('FILE')  # .yaml, .ndjson or .csv
+    tscp = FileTScP(name, file, os.environ.get('MAPPING_FILE'))  # Optional: the mapping for a file that has none
 
     routes = web.RouteTableDef()
 
     @routes.get('/get')
     async def get(request):
-        body = await request.json()
+        body = await read(request)
         user = body['user']
-        keys = body['keys']
+        keys = body.get('keys')  # All of the user's scores when not given
         got = tscp.get(user, keys)
         root.info(f'TScP -> {user}, {keys} -> {json.dumps(got, indent=4)}')
-        return web.json_response(got)
+        return respond(request, got)
 
 
     async def start():
+        await tscp.reloader.start()
         await asyncio.sleep(2)  # Wait 2 seconds for DTE to start
         tscp.start_task()
 
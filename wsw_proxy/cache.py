@@ -0,0 +1,131 @@
+# This file is part of DTE-ERAU. Copyright 2023 Embry-Riddle Aeronautical University
+#
+# DTE-ERAU is free software: you can redistribute it and/or modify it under the terms of the GNU 
+# General Public License as published by the Free Software Foundation, either version 3 of the License, or 
+# (at your option) any later version.
+#
+# DTE-ERAU is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without 
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. 
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with DTE-ERAU. If not, see 
+# <https://www.gnu.org/licenses/>. 
+
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Callable, Hashable, Iterable, Optional
+
+
+class DecisionCache:
+    """
+    A bounded LRU cache of allow/deny decisions. Allows and denies have their own time to live, and every entry
+    belongs to a generation of the policies: bumping the generation when the policies reload makes all the older
+    decisions misses at once. Given a `group` for the keys (such as their user), the decisions of some groups can be
+    dropped without touching the rest. Like everything else here it is only used from the event loop.
+    """
+    def __init__(self, size: int, allow_ttl: timedelta, deny_ttl: timedelta,
+                 group: Optional[Callable[[Hashable], Hashable]] = None):
+        self.size = size
+        self.allow_ttl = allow_ttl.total_seconds()
+        self.deny_ttl = deny_ttl.total_seconds()
+        self.group = group
+        self.generation = 0
+        # Goes up with every invalidation and drop, a decision is only kept if nothing it depends on was invalidated
+        # since the clock it was started at
+        self.clock = 0
+        self._invalidated = 0  # Clock of the last invalidation
+        self._dropped = {}  # type: dict[Hashable, int]  # Clock of the last drop of each group since then
+        self._entries = OrderedDict()  # type: OrderedDict[Hashable, tuple[bool, float, int]]
+        self._groups = {}  # type: dict[Hashable, set[Hashable]]
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0  # Dropped to stay within the size
+        self.expirations = 0  # Outlived their time to live
+        self.invalidations = 0  # From before a reload
+        self.drops = 0  # Dropped with their group
+
+    def invalidate(self) -> None:
+        self.generation += 1
+        self.clock += 1
+        self._invalidated = self.clock
+        self._dropped.clear()
+
+    def drop(self, groups: Iterable[Hashable]) -> None:
+        """
+        Forget the decisions of the given groups
+        """
+        self.clock += 1
+        for group in groups:
+            self._dropped[group] = self.clock
+            for key in self._groups.pop(group, ()):
+                if self._entries.pop(key, None) is not None:
+                    self.drops += 1
+
+    def get(self, key: Hashable) -> Optional[bool]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        decision, expires, generation = entry
+        if generation != self.generation:
+            self.invalidations += 1
+        elif expires <= time.monotonic():
+            self.expirations += 1
+        else:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return decision
+        self._remove(key)
+        self.misses += 1
+        return None
+
+    def put(self, key: Hashable, decision: bool, since: int) -> None:
+        """
+        `since` is the clock from when the decision was started, a decision that raced with a reload or with a drop
+        of its group is not kept
+        """
+        if since < self._invalidated:
+            return
+        group = self.group(key) if self.group is not None else None
+        if group is not None and since < self._dropped.get(group, -1):
+            return
+        ttl = self.allow_ttl if decision else self.deny_ttl
+        if ttl <= 0:
+            return
+        self._entries[key] = (decision, time.monotonic() + ttl, self.generation)
+        self._entries.move_to_end(key)
+        if group is not None:
+            self._groups.setdefault(group, set()).add(key)
+        while len(self._entries) > self.size:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: Hashable) -> None:
+        del self._entries[key]
+        if self.group is not None:
+            group = self.group(key)
+            keys = self._groups.get(group)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._groups[group]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.size,
+            'generation': self.generation,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+            'drops': self.drops,
+        }
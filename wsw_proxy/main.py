@@ -15,7 +15,14 @@ import aiohttp
 import asyncio
 import json
 import logging
+import os
+import time
+import weakref
 from aiohttp import web
+from cache import DecisionCache
+from datetime import timedelta
+from pool import ClientPool
+from wire import WIRE_FORMAT, read_response, request_args
 
 logging.basicConfig(level=logging.INFO)
 logging.getLogger('aiohttp.access').setLevel(logging.ERROR)
@@ -23,42 +30,231 @@ root = logging.getLogger()
 root.debug("Starting...")
 
 routes = web.RouteTableDef()
+connections = weakref.WeakSet()  # type: weakref.WeakSet[Authorizer]  # Of the open connections
 
 PDP_URL = 'http://pdp:9990/auth'
+PDP_GENERATION_URL = 'http://pdp:9990/generation'
+GENERATION_HEADER = 'X-PDP-Generation'
 WS_UPSTREAM = 'ws://10.142.0.3/ws'
 
+# Every connection keeps the decisions for its user, until they expire, the PDP's generation changes or the PDP tells
+# that the user's scores changed
+CACHE_SIZE = int(os.environ.get('WSW_CACHE_SIZE', 1024))
+ALLOW_TTL = timedelta(seconds=float(os.environ.get('WSW_CACHE_ALLOW_TTL', 10)))
+DENY_TTL = timedelta(seconds=float(os.environ.get('WSW_CACHE_DENY_TTL', 2)))
+GENERATION_POLL = float(os.environ.get('WSW_GENERATION_POLL', 1))  # Seconds between asking the PDP for its generation
+# Frames of a connection that may be waiting for their authorization at once, reading from the client stops when it
+# is full. They are still handed on in the order they came in. 1 checks one frame at a time.
+PIPELINE_WINDOW = int(os.environ.get('WSW_PIPELINE_WINDOW', 32))
+# Characters at the start of a frame that are looked at for its ws-wire header, the payload after it is never decoded
+HEADER_SCAN = int(os.environ.get('WSW_HEADER_SCAN', 1024))
+# The header is [message id, request id, event name] for events and subscriptions, else [message id, request id]
+HEADER_FIELDS = {'#evt': 3, '#sub': 3}
+
+pdp = ClientPool('PDP')  # Kept open for as long as the app runs
+pdp_generation = None  # type: str | None  # The last generation of decisions that the PDP told us about, opaque
+pdp_changes = None  # type: int | None  # The count of score changes the PDP was at when we last asked it
+
+def observe_generation(generation) -> None:
+    global pdp_generation
+    if generation is not None and str(generation) != pdp_generation:
+        if pdp_generation is not None:
+            root.info(f'The PDP moved on to generation {generation}, dropping the cached decisions')
+        pdp_generation = str(generation)
+
+def observe_changes(changes, users) -> None:
+    """
+    Drop the decisions of the users whose scores changed, or of everyone when the PDP no longer knows which did
+    """
+    global pdp_changes
+    if pdp_changes is not None and changes != pdp_changes:
+        concerned = [auth for auth in connections if users is None or auth.user in users]
+        for auth in concerned:
+            auth.cache.invalidate()
+        root.debug(f'The scores of {"all" if users is None else len(users)} users changed, '
+                   f'dropped the decisions of {len(concerned)} connections')
+    pdp_changes = changes
+
+async def watch_generation() -> None:
+    """
+    Connections that only hit their caches never hear from the PDP, so ask it now and then, along with which users'
+    scores changed since the last time
+    """
+    while True:
+        try:
+            params = {'since': pdp_changes} if pdp_changes is not None else {}
+            async with pdp.get(PDP_GENERATION_URL, params=params, headers={'Accept': WIRE_FORMAT}) as resp:
+                resp.raise_for_status()
+                body = await read_response(resp)
+                observe_generation(body['generation'])
+                observe_changes(body.get('changes'), set(body['users']) if body.get('users') is not None else None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            root.debug(f'Could not get the generation from the PDP: {e!r}')
+        await asyncio.sleep(GENERATION_POLL)
+
+async def start_watching(app):
+    app['watch_generation'] = asyncio.create_task(watch_generation())
+
+async def stop_watching(app):
+    app['watch_generation'].cancel()
+
 async def check(user: str, tag: str, resource: str) -> bool:
     root.debug(f'Checking for user={user}, tag={tag}, resource={resource}')
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(PDP_URL, json={
+    try:
+        async with pdp.post(PDP_URL, **request_args({
             "resource_group": tag,
             "resource": resource,
             "user": user
-        })
-        allowed = resp.status == 200
-        status_text = 'allowed' if allowed else '--DENIED--'
-        text = f'{status_text}: {user} @ {tag}:{resource}'
-        if allowed:
-            root.info(text)
+        })) as resp:
+            allowed = resp.status == 200
+            observe_generation(resp.headers.get(GENERATION_HEADER))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        root.warning(f'--DENIED--: {user} @ {tag}:{resource}, could not reach the PDP: {e!r}')
+        return False
+    status_text = 'allowed' if allowed else '--DENIED--'
+    text = f'{status_text}: {user} @ {tag}:{resource}'
+    if allowed:
+        root.info(text)
+    else:
+        root.warning(text)
+    return allowed
+
+class Authorizer:
+    """
+    The decisions for the user of one connection, keyed by (tag, resource). Concurrent checks of the same key share
+    one request to the PDP.
+    """
+    def __init__(self, user: str):
+        self.user = user
+        self.cache = DecisionCache(CACHE_SIZE, ALLOW_TTL, DENY_TTL)
+        self.generation = pdp_generation  # The PDP generation that the cache holds decisions of
+        self._checking = {}  # type: dict[tuple[str, str], asyncio.Task]
+        self.coalesced = 0
+        # Pipelining
+        self.window = asyncio.Semaphore(PIPELINE_WINDOW)
+        self.in_flight = 0  # Frames read from the client and not yet handed on
+        self.frames = 0
+        self.latency_total = 0.0  # Of the authorizations
+        self.latency_max = 0.0
+
+    async def authorize(self, msg) -> bool:
+        start = time.monotonic()
+        try:
+            return await is_allowed(self, msg)
+        finally:
+            latency = time.monotonic() - start
+            self.frames += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def metrics(self) -> dict:
+        return {
+            'user': self.user,
+            'in_flight': self.in_flight,
+            'window': PIPELINE_WINDOW,
+            'frames': self.frames,
+            'latency_avg_ms': self.latency_total / self.frames * 1000 if self.frames else 0.0,
+            'latency_max_ms': self.latency_max * 1000,
+        }
+
+    async def check(self, tag: str, resource: str) -> bool:
+        if not isinstance(resource, str):
+            return False  # Not something the PDP can decide on, nor a key of the cache
+        if self.generation != pdp_generation:
+            self.generation = pdp_generation
+            self.cache.invalidate()
+        key = (tag, resource)
+        got = self.cache.get(key)
+        if got is not None:
+            return got
+        pending = self._checking.get(key)
+        if pending is None:
+            pending = self._checking[key] = asyncio.create_task(self._check_and_cache(key))
+            pending.add_done_callback(lambda _task: self._checking.pop(key, None))
         else:
-            root.warning(text)
+            self.coalesced += 1
+        return await asyncio.shield(pending)
+
+    async def _check_and_cache(self, key: tuple[str, str]) -> bool:
+        since = self.cache.clock
+        allowed = await check(self.user, *key)
+        self.cache.put(key, allowed, since)
         return allowed
 
-async def is_allowed(user, msg) -> bool:
-    if not isinstance(msg, list):
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+headers = {'fast': 0, 'full': 0}  # How the headers of the frames were read
+
+def _skip(text: str, pos: int) -> int:
+    while text[pos] in _WHITESPACE:
+        pos += 1
+    return pos
+
+def _decode_head(head: bytes) -> str:
+    """
+    Strictly, so the names that are authorized are the ones that are forwarded. Only a character cut in two by the
+    end of the scan is left out, anything else that is not UTF-8 raises
+    """
+    try:
+        return head.decode()
+    except UnicodeDecodeError as e:
+        if e.reason == 'unexpected end of data' and len(head) == HEADER_SCAN:
+            return head[:e.start].decode()
+        raise
+
+def read_header(raw: str | bytes) -> list | None:
+    """
+    The leading elements of a ws-wire message that decide what it is, read from the first HEADER_SCAN characters of
+    the frame. Only when the header does not fit in there, does not look like ws-wire or is not UTF-8, is the whole
+    frame decoded. None if it is not JSON at all.
+    """
+    head = raw[:HEADER_SCAN]
+    try:
+        if isinstance(head, bytes):
+            head = _decode_head(head)
+        pos = _skip(head, 0)
+        if head[pos] != '[':
+            raise ValueError('Not a list')
+        pos += 1
+        out = []
+        fields = 1
+        while len(out) < fields:
+            value, pos = _decoder.raw_decode(head, _skip(head, pos))
+            if not out:
+                fields = HEADER_FIELDS.get(value, 2) if isinstance(value, str) else 2
+            out.append(value)
+            pos = _skip(head, pos)
+            if head[pos] == ']':
+                break
+            if head[pos] != ',':
+                raise ValueError('Not a list')
+            pos += 1
+        headers['fast'] += 1
+        return out
+    except (ValueError, IndexError):
+        headers['full'] += 1
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return None
+
+async def is_allowed(auth: Authorizer, msg) -> bool:
+    if not isinstance(msg, list) or not msg:
         root.warning('Not a known ws-wire message')
         return False  # This is not a valid message for ws-wire
     mid = msg[0]
     if isinstance(mid, int):
         return True  # This is a response
     elif isinstance(mid, str):
+        if mid in {'#evt', '#sub'} and (len(msg) < 3 or not isinstance(msg[2], str)):
+            return False  # Without a name
         if mid == '#evt':
-            return await check(user, 'wsw-event', msg[2])
+            return await auth.check('wsw-event', msg[2])
         elif mid == '#sub':
-            return await check(user, 'wsw-sub', msg[2])
+            return await auth.check('wsw-sub', msg[2])
         elif mid in {'#subs', '#error'}:
             return True  # This is protocol structure
-        return await check(user, 'wsw-rpc', msg[0])
+        return await auth.check('wsw-rpc', msg[0])
     return False
 
 
@@ -72,6 +268,8 @@ async def proxy(request):
     if user is None:
         root.warning('User attempted to connect without credentials')
         return web.json_response({'error': 'User identification not provided'}, status=403)
+    auth = Authorizer(user)
+    connections.add(auth)
 
     tail_session = aiohttp.ClientSession()
     async with tail_session.ws_connect(WS_UPSTREAM) as ws_tail:
@@ -80,29 +278,60 @@ async def proxy(request):
             async for msg in ws_tail:
                 if msg.type == aiohttp.WSMsgType.TEXT:
                     await ws_head.send_str(msg.data)
+                elif msg.type == aiohttp.WSMsgType.BINARY:
+                    await ws_head.send_bytes(msg.data)
                 elif msg.type == aiohttp.WSMsgType.ERROR:
                     root.error(f'Websocket connection closed with exception: {ws_tail.exception()}')
                     return
                     
         task_tail = asyncio.create_task(proxy_tail())
 
-        async def proxy_head():
-            async for msg in ws_head:
-                if msg.type == aiohttp.WSMsgType.TEXT:
-                    data = json.loads(msg.data)
-                    if await is_allowed(user, data):
-                        # root.info('Allowed')
-                        await ws_tail.send_str(msg.data)
+        # Frames in the order they came in, each with its authorization that is already under way
+        frames = asyncio.Queue()  # type: asyncio.Queue[tuple[str | bytes, object, asyncio.Task] | None]
+
+        async def forward_head():
+            while (frame := await frames.get()) is not None:
+                raw, data, decision = frame
+                try:
+                    allowed = await decision
+                except Exception:
+                    root.exception('Could not authorize a frame, denying it')
+                    allowed = False
+                finally:
+                    auth.in_flight -= 1
+                    auth.window.release()
+                if allowed:
+                    # root.info('Allowed')
+                    if isinstance(raw, bytes):
+                        await ws_tail.send_bytes(raw)
                     else:
-                        # root.warning('Denied')
-                        try:
-                            resp_id = data[1]
-                        except:
-                            resp_id = None
-                        await ws_tail.send_str(json.dumps(['#error', None, resp_id, 'FORBIDDEN']))
-                elif msg.type == aiohttp.WSMsgType.ERROR:
-                    root.error(f'Websocket connection closed with exception: {ws_head.exception()}')
-                    return
+                        await ws_tail.send_str(raw)
+                else:
+                    # root.warning('Denied')
+                    try:
+                        resp_id = data[1]
+                    except:
+                        resp_id = None
+                    await ws_tail.send_str(json.dumps(['#error', None, resp_id, 'FORBIDDEN']))
+
+        async def proxy_head():
+            forwarding = asyncio.create_task(forward_head())
+            try:
+                async for msg in ws_head:
+                    if msg.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                        # Only the header is read, the frame is handed on as it came in
+                        data = read_header(msg.data)
+                        await auth.window.acquire()
+                        auth.in_flight += 1
+                        frames.put_nowait((msg.data, data, asyncio.create_task(auth.authorize(data))))
+                    elif msg.type == aiohttp.WSMsgType.ERROR:
+                        root.error(f'Websocket connection closed with exception: {ws_head.exception()}')
+                        break
+                # Hand on what was already read before we are done
+                frames.put_nowait(None)
+                await forwarding
+            finally:
+                forwarding.cancel()
         task_head = asyncio.create_task(proxy_head())
 
         # Wait for one of the tasks to complete
@@ -115,9 +344,30 @@ async def proxy(request):
     # Return the task for cleanup
     return ws_head
 
+@routes.get('/metrics')
+async def metrics(request):
+    caches = [auth.cache for auth in connections]
+    return web.json_response({
+        'pdp': pdp.metrics(),
+        'generation': pdp_generation,
+        'connections': len(connections),
+        'cache': {
+            'hits': sum(cache.hits for cache in caches),
+            'misses': sum(cache.misses for cache in caches),
+            'entries': sum(len(cache) for cache in caches),
+            'coalesced': sum(auth.coalesced for auth in connections),
+        },
+        'pipelines': [auth.metrics() for auth in connections],
+        'headers': headers,
+    })
+
 def main():
     app = web.Application()
     app.add_routes(routes)
+    app.on_startup.append(pdp.start)
+    app.on_cleanup.append(pdp.stop)
+    app.on_startup.append(start_watching)
+    app.on_cleanup.append(stop_watching)
     web.run_app(app, port=9992)
 
 if __name__ == '__main__':